@@ -1,8 +1,30 @@
+import asyncio
+import bz2
+import csv
+import gzip
+import json
+import lzma
 import fdb
 import os
-
-from collections import Counter
-from time import perf_counter
+import re
+import sqlite3
+import threading
+import zlib
+
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache, partial, wraps
+from hashlib import md5
+from itertools import count, groupby, islice
+from operator import itemgetter, methodcaller
+from queue import Queue
+from time import monotonic, perf_counter
+from types import FunctionType, GeneratorType
+from uuid import uuid4
 
 from django.conf import settings
 from django.utils import timezone
@@ -39,6 +61,7 @@ MRP_INVOICE_CASH_PAYMENT = 'hotovost'
 MRP_INVOICE_VARIABLE_SYMBOL_REGEXP = '20%'
 MRP_INVOICE_MAX_CREDIT_NOTE_VALUE = -5000
 MRP_PROFORMA_INVOICE_VARIABLE_SYMBOL_REGEXP = '920%'
+MRP_EXPOSURE_AGING = (('AGING_0_30', 1), ('AGING_31_60', 31), ('AGING_61_90', 61), ('AGING_90_PLUS', 91))  # overdue exposure bucket: from days after due date
 
 class MRP_INVOICE_PAYMENT:
     ID = 'IDR'
@@ -58,6 +81,9 @@ MRP_INVOICE_PAYMENT_BANK_ID = 6101
 MRP_INVOICE_PAYMENT_CURRENCY = 'EUR'
 MRP_INVOICE_PAYMENT_LOG_USER = 'MRPDBA'
 MRP_INVOICE_PAYMENT_METHOD = 1
+MRP_INVOICE_PAYMENT_INSERT_ATTEMPTS = 3  # ID block is re-reserved on conflict with concurrent writers
+MRP_UNIQUE_KEY_VIOLATION_SQLCODE = -803  # fdb.DatabaseError args are (message, sqlcode, gdscode), fdb never raises IntegrityError
+MRP_UNIQUE_KEY_VIOLATION_GDSCODE = 335544665
 
 class MRP_PAYMENT_METHOD:
     BANK_TRANSFER = 1
@@ -107,6 +133,24 @@ class MRP_PRODUCT_DETAIL:
     ATTRIBUTES = 'VELPOPIS2'
     UPDATE_COUNT = 'UPDCNT'
 
+MRP_PRODUCT_UPDATE_FIELDS = {  # bulk_update_products field: (column, max length, None = BLOB)
+    'NAME': (MRP_PRODUCT.NAME, 64),
+    'SKU': (MRP_PRODUCT.SKU, 64),
+    'EAN': (MRP_PRODUCT.EAN, 25),
+    'METATAGS': (MRP_PRODUCT.METATAGS, 50),
+    'ESHOP_FLAG': (MRP_PRODUCT.ESHOP_FLAG, 50),
+    'ESHOP_INFO': (MRP_PRODUCT.ESHOP_INFO, 50),
+    'SMALL_NOTE': (MRP_PRODUCT.SMALL_NOTE, 50),
+    'ATTRIBUTES': (MRP_PRODUCT.ATTRIBUTES, None),
+    'DESCRIPTION': (MRP_PRODUCT_DETAIL.DESCRIPTION, None),  # SKKARDET
+}
+MRP_PRODUCT_UPDATE_BATCH_SIZE = 500  # rows per savepoint
+MRP_PRODUCT_UPDATE_SAVEPOINT = 'MRP_BULK_UPDATE'
+
+def TO_MRP_PRODUCT_VALUE(field, value):  # field of MRP_PRODUCT_UPDATE_FIELDS, truncated to column length
+    max_length = MRP_PRODUCT_UPDATE_FIELDS[field][1]
+    return str(value)[:max_length] if max_length else TO_MRP_TEXT(str(value))
+
 class MRP_PRODUCT_GROUP:
     NUMBER = 'SKUPINA'
     NAME = 'NAZOV'
@@ -143,6 +187,7 @@ class MRP_STOCK_MOVEMENT:
     COMPANY_ID_NUMBER = 'ICO'
     IS_EXPENSE = 'JEPRIJEM'
     TOTAL = 'CELKOM'
+    UPDATE_COUNT = 'UPDCNT'
 
 MRP_STOCK_MOVEMENT_NUMBERS = (1, 2, 3)
 
@@ -185,6 +230,7 @@ class MRP_TABLE:
     PRODUCT_STATUS = 'SKKARSTA'
     STOCK_MOVEMENT = 'SKPOH'
     USER = 'ADRES'
+    IDS = 'MRP_IDS'  # not MRP's, global temporary table created by MrpService.create_ids_table
 
 MRP_INTEGRITY_CHECK_TABLES = {
     MRP_TABLE.CASH_REGISTER_PAYMENT: ['CASTKA', 'CISFA', 'CUSTOMER', 'CUSTOMERID', 'DATUM', 'EMAIL', 'GUID', 'IDR', 'ID_FV', 'ID_MO', 'ID_SV', 'ISSUEDATE', 'LOG_DATE', 'LOG_USER', 'ODPOVED', 'OKP', 'PARAGON', 'REC_TYPE', 'STATE', 'TYP_EKASY', 'UID', 'UID_STORNO', 'ZPRAVA'],
@@ -201,58 +247,828 @@ MRP_INTEGRITY_CHECK_TABLES = {
     MRP_TABLE.USER: ['ADRESTYP', 'CENSKUP', 'CISOB', 'CISORP', 'CISPOVOL', 'CRPDATNESP', 'CRPKONTDAT', 'CRPSTATUS', 'DAN_URAD', 'DATNAROZ', 'DAT_ZAR', 'DIC', 'DLINHEXP', 'DLINHPROF', 'DODAVATEL', 'DOTRIGGER', 'EANKOD', 'EANSYS', 'EANSYS_DL', 'EMAIL', 'FAKAUTOPRN', 'FAKEMAIL', 'FAKINHEXP', 'FAKINHPROF', 'FAKPDFPWD', 'FAKSLEVA', 'FAKSTRED', 'FAX', 'FIRMA', 'FIRMA2', 'FORMAUHRAD', 'FYZOSOB', 'ICO', 'ICOPRIJ', 'IC_DPH', 'ID', 'IDBANKY', 'IDDODTXT', 'IDKONTAKT', 'IDRADR', 'INE', 'KODADR', 'KODSTAT', 'KREDIT', 'LOG_DATE', 'LOG_USER', 'MENO', 'MESTO', 'NA_PLATNO', 'OBJEMAIL', 'ODBERATEL', 'PDANALYTFP', 'PDANALYTFV', 'PDSYNTETFP', 'PDSYNTETFV', 'POZNAMKA', 'PSC', 'SKONTODNY', 'SKONTOPROC', 'SPECSYMBFP', 'SPECSYMBFV', 'SPLATNOST', 'SPOSOBDOPR', 'STAT', 'TELEFON', 'TELEFON2', 'TELEFON3', 'TEMP_REC', 'TLAC', 'TOLERSPL', 'TYPPOVOL', 'UDPREDKFP', 'UDPREDKFV', 'ULICA', 'UPDCNT', 'USRFLD1', 'USRFLD2', 'USRFLD3', 'USRFLD4', 'USRFLD5', 'VARSYMBFP', 'VARSYMBFV', 'VELOBCH'],
 }
 
-def TO_MRP_NEWLINES(string):
-    mrp_string = "' || ASCII_CHAR(13) || ASCII_CHAR(10) || '".join(
-        list(map(lambda sp: sp.strip(), to_linux_newlines(string).strip().split('\n')))
-    )
-    return f"'{mrp_string}'"
+MRP_ICO_INDEX_TABLES = {  # table: (id, update count, ICO) columns, normalized ICOs of rows kept in MrpStore
+    MRP_TABLE.USER: (MRP_USER.ID, MRP_USER.UPDATE_COUNT, MRP_USER.COMPANY_ID_NUMBER),
+    MRP_TABLE.STOCK_MOVEMENT: (MRP_STOCK_MOVEMENT.ID, MRP_STOCK_MOVEMENT.UPDATE_COUNT, MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER),
+}
+
+class MRP_IDS:
+    BATCH = 'BATCH'
+    ID = 'ID'
+    VALUE = 'VAL'
+
+MRP_IDS_TABLE_THRESHOLD = 1000  # ids, larger sets are joined through MRP_TABLE.IDS, settings.MRP_IDS_TABLE_THRESHOLD overrides
+MRP_IDS_TABLE_LOAD_SIZE = 30000  # characters of ids loaded per query
+MRP_IN_CHUNK_SIZE = 250  # firebird limit for IN is 1500
+
+def TO_MRP_TEXT(string):
+    return '\r\n'.join(map(lambda sp: sp.strip(), to_linux_newlines(string).strip().split('\n')))
+
+def TO_MRP_PLACEHOLDERS(values):
+    return ', '.join(['?'] * len(values))
+
+def TO_MRP_COMPANY_ID_NUMBER(company_id_number):  # as REPLACE(TRIM(ICO), ' ', '') in queries
+    return str(company_id_number).replace(' ', '')
+
+def TO_MRP_STATES_HASHES(rows, first=itemgetter(0), second=itemgetter(1), hexdigest=methodcaller('hexdigest')):  # (id, row concatenated by firebird), md5 in C loops (map)
+    return list(zip(map(first, rows), map(hexdigest, map(md5, map(str.encode, map(second, rows))))))
+
+MRP_RECEIPT_KEYS = ('ReceiptType', 'Custom', 'InvoiceNumber')  # keys of ZPRAVA read without decoding Items
+MRP_RECEIPT_COLON = re.compile(r'\s*:\s*')
+MRP_RECEIPT_DECODER = json.JSONDecoder(parse_float=Decimal)  # amounts exact till parse_price
+
+def TO_MRP_RECEIPT_DATA(raw_data):  # ReceiptData of EKASA_LOG.ZPRAVA, only PD receipts (Items) and messages with repeated or odd keys fully decoded
+    values = {}
+    for key in MRP_RECEIPT_KEYS:
+        start = raw_data.find(f'"{key}"')
+        if start < 0: continue
+        colon = MRP_RECEIPT_COLON.match(raw_data, start + len(key) + 2)
+        if not colon or raw_data.find(f'"{key}"', start + 1) >= 0: return json_loads(raw_data)['ReceiptData']  # string value or nested key of same name
+        values[key] = MRP_RECEIPT_DECODER.raw_decode(raw_data, colon.end())[0]
+        if key == 'ReceiptType' and values[key] == 'PD': return json_loads(raw_data)['ReceiptData']
+    if 'ReceiptType' not in values or 'Custom' not in values: return json_loads(raw_data)['ReceiptData']
+    return values
+
+@lru_cache(maxsize=1024)
+def TO_MRP_FINGERPRINT(query):
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?+', strip_spaces(query))  # IN (?, ?, ...) of any length is one query
 
 
 class MrpIntegrityError(Exception):
     pass
 
 
+MRP_FETCH_BATCH_SIZE = 1000  # rows per fetchmany() in streaming mode
+MRP_STATES_HASH = None  # None = get_hash, 'BATCH' = concatenated by firebird, md5 on client, 'HASH' = firebird HASH() (64 bit), 'SHA256' = firebird 4 CRYPT_HASH, settings.MRP_STATES_HASH overrides
+MRP_STATES_HASHES = (None, 'BATCH', 'HASH', 'SHA256')
+
+MRP_CONNECTION_POOL_SIZE = 4  # per database file, settings.MRP_CONNECTION_POOL_SIZE overrides
+MRP_CONNECTION_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+MRP_CONNECTION_POOL_IDLE_TIMEOUT = 300  # seconds, idle connections are closed after
+MRP_CONNECTION_POOL_PING_AFTER = 30  # seconds, idle connections are pinged before reuse
+MRP_STATEMENT_CACHE_SIZE = 128  # prepared statements per connection
+MRP_TPB_READ_ONLY = fdb.ISOLATION_LEVEL_READ_COMMITED_RO  # precommitted by Firebird, never holds back garbage collection
+MRP_TPB_READ_ONLY_SNAPSHOT = bytes([fdb.isc_tpb_version3, fdb.isc_tpb_read, fdb.isc_tpb_wait, fdb.isc_tpb_concurrency])  # consistent, holds back garbage collection till end
+
+
+class MrpConnectionPoolError(Exception):
+    pass
+
+
+class MrpReadOnlyError(Exception):
+    pass
+
+
+class MrpConnection:
+
+    def __init__(self, database):
+        self.database = database
+        self.pid = os.getpid()
+        self.connection = fdb.connect(
+            host=settings.MRP_HOST, port=settings.MRP_PORT,
+            database=database,
+            user=settings.MRP_USER, password=settings.MRP_PASSWORD,
+            charset='WIN1250'
+        )
+        self.cursor = self.connection.cursor()
+        self.statements = OrderedDict()  # LRU, query: prepared statement (bound to self.cursor), kept with pooled connection across borrows
+        self.released = monotonic()
+        self.has_ids_table = None  # unknown until first large id set
+
+    def prepare(self, query):
+        statement = self.statements.get(query)
+        if statement is not None:
+            self.statements.move_to_end(query)
+            return statement
+        statement = self.cursor.prep(strip_spaces(query))
+        self.statements[query] = statement
+        if len(self.statements) > MRP_STATEMENT_CACHE_SIZE: self.statements.popitem(last=False)  # least recently used, fdb frees its handle when collected
+        return statement
+
+    def is_alive(self):
+        if self.connection.closed: return False
+        if monotonic() - self.released < MRP_CONNECTION_POOL_PING_AFTER: return True
+        try:
+            self.cursor.execute('SELECT 1 FROM RDB$DATABASE')
+            self.cursor.fetchall()
+            self.connection.commit()
+        except fdb.Error:
+            logger.warning('Pooled connection to MRP is dead [firebird://.../%s]', self.database)
+            return False
+        return True
+
+    def close(self):
+        try:
+            if not self.connection.closed: self.connection.close()
+        except fdb.Error:
+            logger.exception('Closing connection to MRP failed [firebird://.../%s]', self.database)
+
+
+class MrpConnectionPool:
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _pools_pid = os.getpid()
+    _forked_connections = []  # inherited from parent process, never used nor closed (shared sockets)
+
+    def __init__(self, database):
+        self.database = database
+        self.size = getattr(settings, 'MRP_CONNECTION_POOL_SIZE', MRP_CONNECTION_POOL_SIZE)
+        self.idle = []  # LIFO, oldest released first
+        self.borrowed = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def get(cls, database):
+        with cls._pools_lock:
+            if cls._pools_pid != os.getpid():  # forked, drop pools of parent process
+                for pool in cls._pools.values(): cls._forked_connections += pool.idle
+                cls._pools = {}
+                cls._pools_pid = os.getpid()
+            if database not in cls._pools: cls._pools[database] = cls(database)
+            return cls._pools[database]
+
+    @classmethod
+    def close_all(cls):
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+        for pool in pools: pool.close()
+
+    def _pop_expired(self):
+        expired = []
+        while self.idle and monotonic() - self.idle[0].released > MRP_CONNECTION_POOL_IDLE_TIMEOUT:
+            expired.append(self.idle.pop(0))
+        return expired
+
+    def borrow(self, timeout=MRP_CONNECTION_POOL_TIMEOUT):
+        deadline = monotonic() + timeout
+        with self.condition:
+            expired = self._pop_expired()
+            while not self.idle and self.borrowed >= self.size:
+                remaining = deadline - monotonic()
+                if remaining <= 0: raise MrpConnectionPoolError(f'No free connection to MRP in {timeout}s [firebird://.../{self.database}]')
+                self.condition.wait(remaining)
+            self.borrowed += 1
+            mrp_connection = self.idle.pop() if self.idle else None
+        for expired_connection in expired: expired_connection.close()
+        try:
+            if mrp_connection and not mrp_connection.is_alive():
+                mrp_connection.close()
+                mrp_connection = None
+            return mrp_connection or MrpConnection(self.database)
+        except Exception:
+            with self.condition:
+                self.borrowed -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, mrp_connection, discard=False):
+        if mrp_connection.pid != os.getpid():  # borrowed before fork
+            self._forked_connections.append(mrp_connection)
+            return
+        with self.condition:
+            self.borrowed -= 1
+            if not discard:
+                mrp_connection.released = monotonic()
+                self.idle.append(mrp_connection)
+            expired = self._pop_expired()
+            self.condition.notify()
+        if discard: mrp_connection.close()
+        for expired_connection in expired: expired_connection.close()
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for mrp_connection in idle: mrp_connection.close()
+
+
+MRP_STORE_FILE = 'mrp.sqlite3'  # in per-user cache dir (XDG_CACHE_HOME or ~/.cache)/mrp, settings.MRP_STORE_PATH overrides
+MRP_CHANGES_TOKENS = 4  # snapshots of states kept per table for get_*_changed_since, older tokens get all states again
+
+
+class MrpStore:
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'MRP_STORE_PATH', None)
+        if not self.path:  # private, never shared temp dir (other users could plant a store)
+            cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mrp')
+            os.makedirs(cache_path, mode=0o700, exist_ok=True)
+            self.path = os.path.join(cache_path, MRP_STORE_FILE)
+        if not os.path.exists(self.path): os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))  # sqlite would create it by umask
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS states (
+                mrp_year INTEGER, table_name TEXT, id INTEGER, hash TEXT, PRIMARY KEY (mrp_year, table_name, id)
+            ) WITHOUT ROWID
+        ''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS icos (
+                database TEXT, table_name TEXT, id INTEGER, update_count INTEGER, ico TEXT, PRIMARY KEY (database, table_name, id)
+            ) WITHOUT ROWID
+        ''')
+        connection.execute('CREATE INDEX IF NOT EXISTS icos_ico ON icos (database, table_name, ico)')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS schemas (
+                database TEXT PRIMARY KEY, tables_formats TEXT, fingerprint TEXT
+            ) WITHOUT ROWID
+        ''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS cash_register_summaries (
+                database TEXT, date TEXT, summary TEXT, PRIMARY KEY (database, date)
+            ) WITHOUT ROWID
+        ''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS changes (
+                token TEXT PRIMARY KEY, mrp_year INTEGER, table_name TEXT
+            )
+        ''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS changes_states (
+                token TEXT, id INTEGER, hash TEXT, PRIMARY KEY (token, id)
+            ) WITHOUT ROWID
+        ''')
+        return connection
+
+    def diff_states(self, mrp_year, table_name, states, commit=True):
+        logger.debug('Diffing %s states (year: %s) [%s]', table_name, mrp_year, self.path)
+        started = perf_counter()
+        with closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TEMP TABLE current_states (id INTEGER PRIMARY KEY, hash TEXT)')
+            connection.executemany('INSERT OR REPLACE INTO current_states VALUES (?, ?)', states)
+            added = [row[0] for row in connection.execute('''
+                SELECT c.id FROM current_states c
+                LEFT JOIN states s ON (s.mrp_year = ? AND s.table_name = ? AND s.id = c.id)
+                WHERE s.id IS NULL ORDER BY c.id
+            ''', (mrp_year, table_name))]
+            changed = [row[0] for row in connection.execute('''
+                SELECT c.id FROM current_states c
+                JOIN states s ON (s.mrp_year = ? AND s.table_name = ? AND s.id = c.id)
+                WHERE s.hash != c.hash ORDER BY c.id
+            ''', (mrp_year, table_name))]
+            removed = [row[0] for row in connection.execute('''
+                SELECT s.id FROM states s
+                LEFT JOIN current_states c ON (c.id = s.id)
+                WHERE s.mrp_year = ? AND s.table_name = ? AND c.id IS NULL ORDER BY s.id
+            ''', (mrp_year, table_name))]
+            if commit:
+                connection.execute('DELETE FROM states WHERE mrp_year = ? AND table_name = ?', (mrp_year, table_name))
+                connection.execute('INSERT INTO states SELECT ?, ?, id, hash FROM current_states', (mrp_year, table_name))
+        logger.debug('Diffed in %fs (added: %d, changed: %d, removed: %d)', (perf_counter() - started), len(added), len(changed), len(removed))
+        return {
+            'ADDED': added,
+            'CHANGED': changed,
+            'REMOVED': removed,
+        }
+
+    def diff_changes(self, mrp_year, table_name, token, states):  # states changed since snapshot of token, new token has snapshot of these states
+        logger.debug('Diffing %s changes since %s (year: %s) [%s]', table_name, token, mrp_year, self.path)
+        new_token = f'{mrp_year}:{uuid4().hex}'
+        with closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TEMP TABLE current_states (id INTEGER PRIMARY KEY, hash TEXT)')
+            connection.executemany('INSERT OR REPLACE INTO current_states VALUES (?, ?)', states)
+            known = bool(token) and bool(connection.execute('SELECT 1 FROM changes WHERE token = ? AND mrp_year = ? AND table_name = ?', (token, mrp_year, table_name)).fetchone())
+            if known:
+                changed = [tuple(row) for row in connection.execute('''
+                    SELECT c.id, c.hash FROM current_states c
+                    LEFT JOIN changes_states s ON (s.token = ? AND s.id = c.id)
+                    WHERE s.hash IS NOT c.hash ORDER BY c.id
+                ''', (token,))]
+                removed = [row[0] for row in connection.execute('''
+                    SELECT s.id FROM changes_states s
+                    LEFT JOIN current_states c ON (c.id = s.id)
+                    WHERE s.token = ? AND c.id IS NULL ORDER BY s.id
+                ''', (token,))]
+            else:  # first sync, or token too old (snapshot dropped), caller resyncs all
+                changed, removed = [tuple(row) for row in connection.execute('SELECT id, hash FROM current_states ORDER BY id')], []
+            connection.execute('INSERT INTO changes VALUES (?, ?, ?)', (new_token, mrp_year, table_name))
+            connection.execute('INSERT INTO changes_states SELECT ?, id, hash FROM current_states', (new_token,))
+            old_tokens = [row[0] for row in connection.execute(
+                'SELECT token FROM changes WHERE mrp_year = ? AND table_name = ? ORDER BY rowid DESC LIMIT -1 OFFSET ?',
+                (mrp_year, table_name, MRP_CHANGES_TOKENS)
+            )]
+            for old_token in old_tokens:
+                connection.execute('DELETE FROM changes_states WHERE token = ?', (old_token,))
+                connection.execute('DELETE FROM changes WHERE token = ?', (old_token,))
+        logger.debug('Diffed changes (changed: %d, removed: %d, full: %s)', len(changed), len(removed), not known)
+        return {
+            'STATES': changed,
+            'REMOVED': removed,
+            'FULL': not known,
+            'TOKEN': new_token,
+        }
+
+    def diff_ico_index(self, database, table_name, versions):  # [(id, update count)] of all rows, ids to be (re)indexed
+        with closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TEMP TABLE current_versions (id INTEGER PRIMARY KEY, update_count INTEGER)')
+            connection.executemany('INSERT OR REPLACE INTO current_versions VALUES (?, ?)', versions)
+            changed = [row[0] for row in connection.execute('''
+                SELECT c.id FROM current_versions c
+                LEFT JOIN icos i ON (i.database = ? AND i.table_name = ? AND i.id = c.id)
+                WHERE i.id IS NULL OR i.update_count IS NOT c.update_count ORDER BY c.id
+            ''', (database, table_name))]
+            connection.execute('''
+                DELETE FROM icos WHERE database = ? AND table_name = ? AND id NOT IN (SELECT id FROM current_versions)
+            ''', (database, table_name))
+        return changed
+
+    def set_ico_index(self, database, table_name, rows):  # [(id, update count, ICO)]
+        with closing(self.connect()) as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO icos VALUES (?, ?, ?, ?, ?)', [(database, table_name, *row) for row in rows])
+
+    def get_ico_index_ids(self, database, table_name, icos):  # {ICO: [ids]}
+        ids = {}
+        with closing(self.connect()) as connection:
+            for icos_chunk in create_chunks(list(icos), 500):  # sqlite limit for variables is 999
+                for ico, mrp_id in connection.execute(
+                    f'SELECT ico, id FROM icos WHERE database = ? AND table_name = ? AND ico IN ({TO_MRP_PLACEHOLDERS(icos_chunk)}) ORDER BY id',
+                    (database, table_name, *icos_chunk)
+                ): ids.setdefault(ico, []).append(mrp_id)
+        return ids
+
+    def get_ico_index_max_id(self, database, table_name):  # None if index was never built
+        with closing(self.connect()) as connection:
+            return connection.execute('SELECT MAX(id) FROM icos WHERE database = ? AND table_name = ?', (database, table_name)).fetchone()[0]
+
+    def get_ico_index_versions(self, database, table_name):  # [(id, update count, ICO)]
+        with closing(self.connect()) as connection:
+            return connection.execute('SELECT id, update_count, ico FROM icos WHERE database = ? AND table_name = ?', (database, table_name)).fetchall()
+
+    def get_ico_index_states(self, database, table_name):  # [(max id, ICO, update counts sum)] grouped by ICO
+        with closing(self.connect()) as connection:
+            return connection.execute(
+                'SELECT MAX(id), ico, SUM(update_count) FROM icos WHERE database = ? AND table_name = ? GROUP BY ico',
+                (database, table_name)
+            ).fetchall()
+
+    def get_schema(self, database):  # (tables formats, fingerprint) of last successful integrity check
+        with closing(self.connect()) as connection:
+            row = connection.execute('SELECT tables_formats, fingerprint FROM schemas WHERE database = ?', (database,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_schema(self, database, tables_formats, fingerprint):
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO schemas VALUES (?, ?, ?)', (database, tables_formats, fingerprint))
+
+    @staticmethod
+    def _loads_cash_register_summary(summary):  # json, *_AMOUNT decimals stored as strings
+        return json.loads(summary, object_hook=lambda values: {key: Decimal(value) if key.endswith('_AMOUNT') else value for key, value in values.items()})
+
+    def get_cash_register_days(self, database, mrp_dates):
+        with closing(self.connect()) as connection:
+            summaries = {}
+            for mrp_dates_chunk in create_chunks(mrp_dates, 500):  # sqlite limit for variables is 999
+                summaries.update({datetime.strptime(date, '%Y-%m-%d').date(): self._loads_cash_register_summary(summary) for date, summary in connection.execute(
+                    f'SELECT date, summary FROM cash_register_summaries WHERE database = ? AND date IN ({TO_MRP_PLACEHOLDERS(mrp_dates_chunk)})',
+                    (database, *[mrp_date.isoformat() for mrp_date in mrp_dates_chunk])
+                )})
+        return summaries
+
+    def set_cash_register_days(self, database, summaries):  # finalized days only, never recomputed
+        with closing(self.connect()) as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO cash_register_summaries VALUES (?, ?, ?)', [
+                (database, mrp_date.isoformat(), json.dumps(summary, default=str)) for mrp_date, summary in summaries.items()
+            ])
+
+
+MRP_CACHE_SIZE = 10000  # entries, settings.MRP_CACHE_SIZE overrides
+MRP_CACHE_TTL = 300  # seconds, settings.MRP_CACHE_TTL overrides
+
+
+class MrpCache:
+
+    def __init__(self, size=None, ttl=None, backend=None):
+        self.size = size or getattr(settings, 'MRP_CACHE_SIZE', MRP_CACHE_SIZE)
+        self.ttl = ttl or getattr(settings, 'MRP_CACHE_TTL', MRP_CACHE_TTL)
+        self.backend = backend  # shared by processes, django cache API (get_many, set_many, delete_many)
+        self.entries = OrderedDict()  # (mrp_year, name, mrp_id): (expires, value), LRU
+        self.versions = {}  # (mrp_year, name): {mrp_id: version} seen by last refresh
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_backend_key(key):
+        return 'mrp:{}:{}:{}'.format(*key)
+
+    def get_many(self, mrp_year, name, ids):
+        results, missing = {}, []
+        now = monotonic()
+        with self.lock:
+            for mrp_id in ids:
+                entry = self.entries.get((mrp_year, name, mrp_id))
+                if entry and entry[0] > now:
+                    self.entries.move_to_end((mrp_year, name, mrp_id))
+                    results[mrp_id] = dict(entry[1]) if isinstance(entry[1], dict) else entry[1]  # callers may modify results
+                else:
+                    if entry: del self.entries[(mrp_year, name, mrp_id)]
+                    missing.append(mrp_id)
+        if missing and self.backend is not None:
+            backend_keys = {self._get_backend_key((mrp_year, name, mrp_id)): mrp_id for mrp_id in missing}
+            backend_results = {backend_keys[key]: value for key, value in self.backend.get_many(backend_keys).items()}
+            self._set_local(mrp_year, name, backend_results)
+            results.update(backend_results)  # unpickled copies
+        return results
+
+    def _set_local(self, mrp_year, name, values):
+        expires = monotonic() + self.ttl
+        with self.lock:
+            for mrp_id, value in values.items():
+                self.entries[(mrp_year, name, mrp_id)] = (expires, dict(value) if isinstance(value, dict) else value)
+                self.entries.move_to_end((mrp_year, name, mrp_id))
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def set_many(self, mrp_year, name, values):
+        self._set_local(mrp_year, name, values)
+        if self.backend is not None: self.backend.set_many({self._get_backend_key((mrp_year, name, mrp_id)): value for mrp_id, value in values.items()}, self.ttl)
+
+    def invalidate(self, mrp_year, name, ids=None):  # ids None = all of name
+        with self.lock:
+            keys = [key for key in self.entries if key[:2] == (mrp_year, name) and (ids is None or key[2] in ids)]
+            for key in keys: del self.entries[key]
+        if self.backend is not None and ids: self.backend.delete_many([self._get_backend_key((mrp_year, name, mrp_id)) for mrp_id in ids])
+
+    def refresh(self, mrp_year, name, versions):  # {mrp_id: version}, e.g. UPDCNT or states hash
+        with self.lock:
+            previous, self.versions[(mrp_year, name)] = self.versions.get((mrp_year, name)), versions
+        if previous is None:  # first refresh, entries cached before cannot be verified
+            self.invalidate(mrp_year, name)
+            if self.backend is not None: self.backend.delete_many([self._get_backend_key((mrp_year, name, mrp_id)) for mrp_id in versions])
+            return None
+        changed = {mrp_id: (previous.get(mrp_id), versions.get(mrp_id)) for mrp_id in previous.keys() | versions.keys() if previous.get(mrp_id) != versions.get(mrp_id)}
+        if changed: self.invalidate(mrp_year, name, set(changed))
+        logger.debug('Invalidated %d cached %s (year: %s)', len(changed), name, mrp_year)
+        return changed  # {mrp_id: (old version, new version)}
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.versions = {}
+
+
+MRP_EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+MRP_EXPORT_COMPRESSIONS = {'gz': gzip.open, 'gzip': gzip.open, 'bz2': bz2.open, 'bzip2': bz2.open, 'xz': lzma.open}  # csv, jsonl
+MRP_EXPORT_PARQUET_COMPRESSIONS = {'gz': 'gzip', 'gzip': 'gzip', 'snappy': 'snappy', 'zstd': 'zstd', 'brotli': 'brotli', 'lz4': 'lz4', 'none': 'none'}  # columns compressed by pyarrow
+MRP_EXPORT_BATCH_SIZE = 10000  # rows per parquet row group
+MRP_EXPORT_CHUNK_SIZE = 5000  # products fetched at once
+
+
+class MrpExportError(Exception):
+    pass
+
+
+def TO_MRP_EXPORT_VALUE(value):  # json, exact decimals as strings
+    if isinstance(value, Decimal): return str(value)
+    if isinstance(value, (date, datetime)): return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not exportable')
+
+
+class MrpExport:  # rows written as they come, texts already decoded from WIN1250 by fdb
+
+    def __init__(self, path, format=None, compression=None, fields=None, encoding='utf-8', errors='replace'):
+        self.path = path
+        name, extension = os.path.splitext(path)
+        if compression is None and extension[1:] in MRP_EXPORT_COMPRESSIONS: compression, extension = extension[1:], os.path.splitext(name)[1]
+        self.format = format or extension[1:]
+        self.compression = compression
+        self.fields = fields  # None = keys of first row
+        self.encoding = encoding  # csv only, e.g. cp1250 for accounting
+        self.errors = errors  # csv only, characters missing in encoding (e.g. emoji in cp1250) written as '?' by default, 'strict' raises
+        if self.format not in MRP_EXPORT_FORMATS: raise MrpExportError(f'Unknown export format {self.format!r}, use one of {MRP_EXPORT_FORMATS}')
+        compressions = MRP_EXPORT_PARQUET_COMPRESSIONS if self.format == 'parquet' else MRP_EXPORT_COMPRESSIONS
+        if self.compression and self.compression not in compressions:
+            raise MrpExportError(f'Unknown {self.format} compression {self.compression!r}, use one of {tuple(compressions)}')
+
+    def _open(self, encoding, errors='strict'):
+        if self.compression: return MRP_EXPORT_COMPRESSIONS[self.compression](self.path, 'wt', encoding=encoding, errors=errors, newline='')
+        return open(self.path, 'w', encoding=encoding, errors=errors, newline='')
+
+    def write(self, rows):
+        logger.debug('Exporting %s [%s]', self.format, self.path)
+        started = perf_counter()
+        rows_count = getattr(self, f'_write_{self.format}')(iter(rows))
+        logger.debug('Exported %d rows in %fs', rows_count, (perf_counter() - started))
+        return rows_count
+
+    def _write_csv(self, rows):
+        rows_count = 0
+        with self._open(self.encoding, self.errors) as f:
+            writer = None
+            for row in rows:
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=self.fields or list(row), extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow(row)  # str() of decimals and dates is exact and ISO
+                rows_count += 1
+        return rows_count
+
+    def _write_jsonl(self, rows):
+        rows_count = 0
+        with self._open('utf-8') as f:
+            for row in rows:
+                if self.fields: row = {field: row.get(field) for field in self.fields}
+                f.write(json.dumps(row, ensure_ascii=False, default=TO_MRP_EXPORT_VALUE) + '\n')
+                rows_count += 1
+        return rows_count
+
+    def _write_parquet(self, rows):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise MrpExportError('Parquet export requires pyarrow')
+        rows_count = 0
+        writer = None
+        try:
+            while batch := list(islice(rows, MRP_EXPORT_BATCH_SIZE)):
+                if writer is None:  # schema of first batch, decimals widened as batches may differ in precision
+                    schema = pa.Table.from_pylist(batch).schema
+                    if self.fields: schema = pa.schema([schema.field(field) for field in self.fields])
+                    schema = pa.schema([
+                        pa.field(f.name, pa.decimal128(38, f.type.scale)) if pa.types.is_decimal(f.type) else pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                        for f in schema
+                    ])
+                    writer = pq.ParquetWriter(self.path, schema, compression=MRP_EXPORT_PARQUET_COMPRESSIONS[self.compression or 'snappy'])
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                rows_count += len(batch)
+        finally:
+            if writer: writer.close()
+        return rows_count
+
+
+MRP_METRICS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)  # seconds, execute + fetch time
+
+
+class MrpMetrics:
+
+    def __init__(self, buckets=MRP_METRICS_BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self.hooks = []  # called with every query record, e.g. to push it to StatsD
+        self.lock = threading.Lock()
+        self.queries = {}  # (method, fingerprint): stats
+
+    @staticmethod
+    def get_size(rows):  # approximate, text/blob length and 8 bytes for any other value
+        return sum(len(value) if isinstance(value, (str, bytes)) else 8 for row in rows for value in row)
+
+    @staticmethod
+    def get_query_id(fingerprint):
+        return f'{zlib.crc32(fingerprint.encode()):08x}'
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, method, fingerprint, execute_time, fetch_time=0.0, rows=0, size=0):
+        if not self.enabled: return
+        total_time = execute_time + fetch_time
+        with self.lock:
+            stats = self.queries.get((method, fingerprint))
+            if not stats:
+                stats = self.queries[(method, fingerprint)] = {
+                    'COUNT': 0,
+                    'EXECUTE_TIME': 0.0,
+                    'FETCH_TIME': 0.0,
+                    'MAX_TIME': 0.0,
+                    'ROWS': 0,
+                    'BYTES': 0,
+                    'HISTOGRAM': [0] * (len(self.buckets) + 1),  # last one is +Inf
+                }
+            stats['COUNT'] += 1
+            stats['EXECUTE_TIME'] += execute_time
+            stats['FETCH_TIME'] += fetch_time
+            stats['MAX_TIME'] = max(stats['MAX_TIME'], total_time)
+            stats['ROWS'] += rows
+            stats['BYTES'] += size
+            stats['HISTOGRAM'][bisect_left(self.buckets, total_time)] += 1
+        if not self.hooks: return
+        record = {
+            'METHOD': method,
+            'FINGERPRINT': fingerprint,
+            'QUERY_ID': self.get_query_id(fingerprint),
+            'EXECUTE_TIME': execute_time,
+            'FETCH_TIME': fetch_time,
+            'ROWS': rows,
+            'BYTES': size,
+        }
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                logger.exception('MRP metrics hook %r failed', hook)
+
+    def reset(self):
+        with self.lock:
+            self.queries = {}
+
+    def _get_percentile(self, histogram, count, max_time, percentile):  # upper bound of the bucket
+        rank, cumulative = count * percentile, 0
+        for bucket, bucket_count in enumerate(histogram):
+            cumulative += bucket_count
+            if cumulative >= rank: return min(self.buckets[bucket], max_time) if bucket < len(self.buckets) else max_time
+        return max_time
+
+    def get_stats(self, by_method=False):
+        with self.lock:
+            queries = [(key, dict(stats, HISTOGRAM=list(stats['HISTOGRAM']))) for key, stats in self.queries.items()]
+        if by_method:
+            methods = {}
+            for (method, _), stats in queries:
+                if method not in methods:
+                    methods[method] = stats
+                    continue
+                merged = methods[method]
+                for key in ('COUNT', 'EXECUTE_TIME', 'FETCH_TIME', 'ROWS', 'BYTES'): merged[key] += stats[key]
+                merged['MAX_TIME'] = max(merged['MAX_TIME'], stats['MAX_TIME'])
+                merged['HISTOGRAM'] = [a + b for a, b in zip(merged['HISTOGRAM'], stats['HISTOGRAM'])]
+            queries = [((method, None), stats) for method, stats in methods.items()]
+        results = []
+        for (method, fingerprint), stats in queries:
+            histogram = stats.pop('HISTOGRAM')
+            results.append({
+                'METHOD': method,
+                **({} if by_method else {'FINGERPRINT': fingerprint, 'QUERY_ID': self.get_query_id(fingerprint)}),
+                **stats,
+                'TOTAL_TIME': stats['EXECUTE_TIME'] + stats['FETCH_TIME'],
+                'P50': self._get_percentile(histogram, stats['COUNT'], stats['MAX_TIME'], 0.5),
+                'P95': self._get_percentile(histogram, stats['COUNT'], stats['MAX_TIME'], 0.95),
+                'P99': self._get_percentile(histogram, stats['COUNT'], stats['MAX_TIME'], 0.99),
+            })
+        return sorted(results, key=lambda stats: stats['TOTAL_TIME'], reverse=True)
+
+    def to_prometheus(self, prefix='mrp_query'):
+        with self.lock:
+            queries = [(key, dict(stats, HISTOGRAM=list(stats['HISTOGRAM']))) for key, stats in self.queries.items()]
+        lines = [
+            f'# HELP {prefix}_seconds MRP query execute + fetch time',
+            f'# TYPE {prefix}_seconds histogram',
+        ]
+        totals = {'execute_seconds': [], 'fetch_seconds': [], 'rows': [], 'bytes': []}
+        for (method, fingerprint), stats in sorted(queries, key=lambda query: query[0]):
+            labels = f'method="{method}",query="{self.get_query_id(fingerprint)}"'
+            cumulative = 0
+            for bucket, bucket_count in enumerate(stats['HISTOGRAM']):
+                cumulative += bucket_count
+                le = f'{self.buckets[bucket]:g}' if bucket < len(self.buckets) else '+Inf'
+                lines.append(f'{prefix}_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_seconds_sum{{{labels}}} {stats["EXECUTE_TIME"] + stats["FETCH_TIME"]:f}')
+            lines.append(f'{prefix}_seconds_count{{{labels}}} {stats["COUNT"]}')
+            totals['execute_seconds'].append(f'{prefix}_execute_seconds_total{{{labels}}} {stats["EXECUTE_TIME"]:f}')
+            totals['fetch_seconds'].append(f'{prefix}_fetch_seconds_total{{{labels}}} {stats["FETCH_TIME"]:f}')
+            totals['rows'].append(f'{prefix}_rows_total{{{labels}}} {stats["ROWS"]}')
+            totals['bytes'].append(f'{prefix}_bytes_total{{{labels}}} {stats["BYTES"]}')
+        for name, samples in totals.items():
+            lines += [f'# TYPE {prefix}_{name}_total counter', *samples]
+        return '\n'.join(lines) + '\n'
+
+    def to_statsd(self, prefix='mrp.query'):  # gauges of the totals, for a periodic flush
+        return ''.join(
+            f'{prefix}.{stats["METHOD"]}.{stats["QUERY_ID"]}.count:{stats["COUNT"]}|g\n'
+            f'{prefix}.{stats["METHOD"]}.{stats["QUERY_ID"]}.time:{stats["TOTAL_TIME"] * 1000:f}|g\n'
+            f'{prefix}.{stats["METHOD"]}.{stats["QUERY_ID"]}.rows:{stats["ROWS"]}|g\n'
+            f'{prefix}.{stats["METHOD"]}.{stats["QUERY_ID"]}.bytes:{stats["BYTES"]}|g\n'
+            for stats in self.get_stats()
+        )
+
+
+mrp_metrics = MrpMetrics()
+
+
+def _track_caller(method):  # public MrpService method sets caller of its queries once, nested public calls keep the outermost one
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._caller: return method(self, *args, **kwargs)
+        self._caller = method.__name__
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._caller = None
+        return _iter_tracked(self, result, method.__name__) if isinstance(result, GeneratorType) else result  # streamed queries run after return
+    return wrapper
+
+
+def _iter_tracked(mrp_service, rows, caller):
+    while True:
+        tracked = not mrp_service._caller  # consumed by other public method otherwise
+        if tracked: mrp_service._caller = caller
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        finally:
+            if tracked: mrp_service._caller = None
+        yield row
+
+
 class MrpService:
 
-    def __init__(self, mrp_year=None):
+    def __init__(self, mrp_year=None, pooled=True, fetch_batch_size=MRP_FETCH_BATCH_SIZE, store=None, cache=None, parallel=1, read_only=False, snapshot=False, ico_index=False, states_hash=None):
         self.connection = None
         self.cursor = None
         self.mrp_year = mrp_year or timezone.now().year
+        self.pooled = pooled
+        self.fetch_batch_size = fetch_batch_size
+        self._store = store  # MrpStore created on first use, plain reads never touch disk
+        self.cache = cache  # MrpCache shared by services, None = disabled
+        self.parallel = parallel  # max connections for chunks of id lookups (free ones only), each chunk in own transaction (no shared snapshot)
+        self.read_only = read_only  # reports, transaction is not committed and writers raise MrpReadOnlyError
+        self.snapshot = snapshot  # all queries see database as of first one
+        if snapshot and parallel > 1: raise ValueError('Parallel chunks run in own transactions, they cannot share snapshot')
+        if not pooled and parallel > 1: raise ValueError('Parallel chunks borrow free pooled connections, use pooled=True')
+        self.ico_index = ico_index  # lookups by ICO through MrpStore index, see refresh_ico_index
+        self._ico_index_refreshed = set()  # tables with index up to date in this service (refreshed or new rows added)
+        self.states_hash = states_hash or getattr(settings, 'MRP_STATES_HASH', MRP_STATES_HASH)  # changing it changes all states once
+        if self.states_hash not in MRP_STATES_HASHES: raise ValueError(f'Unknown states hash {self.states_hash!r}, use one of {MRP_STATES_HASHES}')
+        self.queries_count = 0  # executed queries (round trips), useful for benchmarks
+        self._mrp_connection = None
+        self._caller = None  # public method running now (metrics), see _track_caller and _run_chunk
+        self._queries = {}  # id(cursor): (method, fingerprint, execute time) of query not fetched yet
+        self._ids_batches = count(1)  # loads of MRP_TABLE.IDS in transaction, rows deleted on commit
+
+    @property
+    def store(self):
+        if self._store is None: self._store = MrpStore()
+        return self._store
 
     def __enter__(self):
         self._connect()
+        self._begin()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.connection.commit()
-        self.connection.close()
-        logger.debug('Connection to MRP closed')
+        try:
+            if self.read_only: self.connection.rollback()  # nothing to commit, ends transaction before release
+            else: self.connection.commit()
+        except fdb.Error:
+            self._disconnect(discard=True)  # closing rolls back
+            raise
+        self._disconnect()
 
     def _connect(self):
         MRP_DATABASE = os.path.join(settings.MRP_DATA_PATH, settings.MRP_DATA_FILES[self.mrp_year])
-        self.connection = fdb.connect(
-            host=settings.MRP_HOST, port=settings.MRP_PORT,
-            database=MRP_DATABASE,
-            user=settings.MRP_USER, password=settings.MRP_PASSWORD,
-            charset='WIN1250'
-        )
-        self.cursor = self.connection.cursor()
+        if self.pooled:
+            self._mrp_connection = MrpConnectionPool.get(MRP_DATABASE).borrow()
+        else:
+            self._mrp_connection = MrpConnection(MRP_DATABASE)
+        self.connection = self._mrp_connection.connection
+        self.cursor = self._mrp_connection.cursor
         logger.debug('Connection to MRP (year: %s) successful [firebird://.../%s]', self.mrp_year, MRP_DATABASE)
 
-    def _execute(self, query):
-        query = strip_spaces(query)
-        logger.debug('Executing SQL: %s', query)
+    def _begin(self):  # default transaction (read committed, read write) is started by fdb on first query
+        if self.read_only: self.connection.begin(tpb=MRP_TPB_READ_ONLY_SNAPSHOT if self.snapshot else MRP_TPB_READ_ONLY)
+        elif self.snapshot: self.connection.begin(tpb=fdb.ISOLATION_LEVEL_SNAPSHOT)
+
+    def _disconnect(self, discard=False):
+        self._record_queries()
+        if self.pooled:
+            MrpConnectionPool.get(self._mrp_connection.database).release(self._mrp_connection, discard=discard)
+            logger.debug('Connection to MRP returned to pool')
+        else:
+            self._mrp_connection.close()
+            logger.debug('Connection to MRP closed')
+        self._mrp_connection = None
+        self.connection = None
+        self.cursor = None
+
+    def _check_writable(self, method):
+        if self.read_only: raise MrpReadOnlyError(f'{method} writes to MRP, use MrpService without read_only')
+
+    def _record_query(self, cursor, fetch_time=0.0, rows=0, size=0):
+        query = self._queries.pop(id(cursor), None)
+        if query: mrp_metrics.record(*query, fetch_time, rows, size)
+
+    def _record_queries(self):  # queries without results (DML) or not streamed till the end
+        queries, self._queries = self._queries, {}
+        for query in queries.values(): mrp_metrics.record(*query)
+
+    def _execute(self, query, params=None, cursor=None, method=None):
+        if params is not None: params = tuple(params)  # fdb accepts list/tuple only
         started = perf_counter()
-        self.cursor.execute(query)
-        logger.debug('Executed in %fs', (perf_counter()-started))
+        if cursor:  # own cursor (streaming), prepared by fdb
+            logger.debug('Executing SQL: %s %s', strip_spaces(query), params or '')
+            cursor.execute(strip_spaces(query), params)
+        else:
+            statement = self._mrp_connection.prepare(query)
+            logger.debug('Executing SQL: %s %s', statement.sql, params or '')
+            self.cursor.execute(statement, params)
+        execute_time = perf_counter() - started
+        self.queries_count += 1
+        logger.debug('Executed in %fs', execute_time)
+        cursor = cursor or self.cursor
+        self._record_query(cursor)
+        if mrp_metrics.enabled: self._queries[id(cursor)] = (method or self._caller, TO_MRP_FINGERPRINT(query), execute_time)
 
     def _fetchall(self):
         logger.debug('Fetching results')
         started = perf_counter()
         results = []
-        for row in self.cursor.fetchall():
+        rows = self.cursor.fetchall()
+        for row in rows:
             results.append(row[0] if len(row) == 1 else row)
-        logger.debug('Fetched %d results in %fs', len(results), (perf_counter() - started))
+        fetch_time = perf_counter() - started
+        logger.debug('Fetched %d results in %fs', len(results), fetch_time)
+        self._record_query(self.cursor, fetch_time, len(results), mrp_metrics.get_size(rows) if mrp_metrics.enabled else 0)
         return results
 
     def _fetchone(self):
@@ -265,74 +1081,446 @@ class MrpService:
         results = []
         for row in self.cursor.fetchallmap():
             results.append({key: value for key, value in row.items()})
-        logger.debug('Fetched %d results in %fs', len(results), (perf_counter() - started))
+        fetch_time = perf_counter() - started
+        logger.debug('Fetched %d results in %fs', len(results), fetch_time)
+        size = mrp_metrics.get_size(row.values() for row in results) if mrp_metrics.enabled else 0
+        self._record_query(self.cursor, fetch_time, len(results), size)
         return results
 
     def _fetchonemap(self):
         fetchallmap = self._fetchallmap()
         return fetchallmap[0] if fetchallmap else None
 
+    def _iterall(self, cursor=None, batch_size=None):
+        cursor = cursor or self.cursor
+        batch_size = batch_size or self.fetch_batch_size
+        logger.debug('Streaming results (batch size: %d)', batch_size)
+        started = perf_counter()
+        count, size, fetch_time = 0, 0, 0.0
+        while True:
+            fetch_started = perf_counter()
+            rows = cursor.fetchmany(batch_size)
+            fetch_time += perf_counter() - fetch_started  # time spent by consumer excluded
+            if not rows: break
+            count += len(rows)
+            if mrp_metrics.enabled: size += mrp_metrics.get_size(rows)
+            for row in rows:
+                yield row[0] if len(row) == 1 else row
+        logger.debug('Streamed %d results in %fs', count, (perf_counter() - started))
+        self._record_query(cursor, fetch_time, count, size)
+
+    def _iterallmap(self, cursor=None, batch_size=None):
+        cursor = cursor or self.cursor
+        columns = [column[0] for column in cursor.description]
+        for row in self._iterall(cursor, batch_size):
+            yield dict(zip(columns, row if len(columns) > 1 else (row,)))
+
+    def _executemany(self, query, params_list):
+        statement = self._mrp_connection.prepare(query)
+        logger.debug('Executing SQL: %s (%d times)', statement.sql, len(params_list))
+        started = perf_counter()
+        self.cursor.executemany(statement, [tuple(params) for params in params_list])
+        execute_time = perf_counter() - started
+        self.queries_count += len(params_list)
+        logger.debug('Executed in %fs', execute_time)
+        self._record_query(self.cursor)
+        mrp_metrics.record(self._caller, TO_MRP_FINGERPRINT(query), execute_time)
+
+    def _iterquery(self, query, params=None, mapped=False):
+        return self._iterquery_rows(query, params, mapped, self._caller)  # caller known now, not when streamed
+
+    def _iterquery_rows(self, query, params, mapped, method):
+        cursor = self.connection.cursor()  # own cursor, queries executed while streaming must not reset it
+        self._execute(query, params, cursor=cursor, method=method)
+        yield from (self._iterallmap(cursor) if mapped else self._iterall(cursor))
+
+    def _get_states(self, query, name, params=None, stream=False):
+        if self.states_hash: return self._get_hashed_states(query, params, stream)
+        if stream: return self._iter_states(query, params)
+        self._execute(query, params)
+        states = self._fetchall()
+        logger.debug('Hashing %s states', name)
+        started = perf_counter()
+        results = list(zip([s[0] for s in states], self._hash_states(states)))  # tuple(id, hash)
+        logger.debug('Hashed in %fs', (perf_counter() - started))
+        return results
+
+    def _iter_states(self, query, params=None):
+        rows = self._iterquery(query, params)
+        while states := list(islice(rows, self.fetch_batch_size)):
+            yield from zip([s[0] for s in states], self._hash_states(states))  # tuple(id, hash)
+
+    def _hash_states(self, states):  # rows (id, *values)
+        return [get_hash(s[1:]) for s in states]
+
+    def _get_hashed_states(self, query, params=None, stream=False):  # hashed by firebird, only (id, hash) transferred, BATCH transfers (id, row) and hashes batches
+        columns_count = self._mrp_connection.prepare(query).n_output_params
+        COLUMNS = ', '.join(f'C{i}' for i in range(columns_count))
+        ROW = ' || '.join(f"COALESCE('|' || STATES.C{i}, '~')" for i in range(1, columns_count))  # NULL differs from ''
+        HASH = {'BATCH': ROW, 'HASH': f'HASH({ROW})', 'SHA256': f'HEX_ENCODE(CRYPT_HASH({ROW} USING SHA256))'}[self.states_hash]
+        query = f'SELECT STATES.C0, {HASH} FROM ({query}) STATES ({COLUMNS})'
+        if self.states_hash == 'BATCH':
+            if stream: return self._iter_batch_hashed_states(query, params)
+            self._execute(query, params)
+            return TO_MRP_STATES_HASHES(self._fetchall())
+        if stream: return ((s[0], str(s[1])) for s in self._iterquery(query, params))  # tuple(id, hash)
+        self._execute(query, params)
+        return [(s[0], str(s[1])) for s in self._fetchall()]
+
+    def _iter_batch_hashed_states(self, query, params=None):
+        rows = self._iterquery(query, params)
+        while states := list(islice(rows, self.fetch_batch_size)):
+            yield from TO_MRP_STATES_HASHES(states)  # tuple(id, hash)
+
+    # Deltas by diff of states against snapshot of token in MrpStore (same diff as diff_states), so edits made anywhere,
+    # removed rows and child tables in states (payments, SKKARSTA, SKKARDET) are seen. Database side still reads all states,
+    # with states_hash HASH/SHA256 only (id, hash) pairs are transferred, so sync cost is in changes on client side.
+    def _get_changed_since(self, table_name, token, states):  # {STATES, REMOVED, FULL, TOKEN}, FULL = token None or unknown, STATES are all states
+        if token and token.partition(':')[0] != str(self.mrp_year): raise ValueError(f'Changes token {token} does not belong to MRP year {self.mrp_year}')
+        return self.store.diff_changes(self.mrp_year, table_name, token, states)
+
     def _get_table_fields(self, table_name):
+        return self._get_tables_fields([table_name]).get(table_name, [])
+
+    def _get_tables_fields(self, tables_names):
         query = f'''
-            SELECT TRIM(RDB$FIELD_NAME) FROM RDB$RELATION_FIELDS WHERE RDB$RELATION_NAME='{table_name}' ORDER BY RDB$FIELD_NAME
+            SELECT TRIM(RDB$RELATION_NAME), TRIM(RDB$FIELD_NAME) FROM RDB$RELATION_FIELDS
+            WHERE RDB$RELATION_NAME IN ({TO_MRP_PLACEHOLDERS(tables_names)}) ORDER BY RDB$RELATION_NAME, RDB$FIELD_NAME
         '''
-        self._execute(query)
-        return self._fetchall()
+        self._execute(query, tables_names)
+        tables_fields = {}
+        for table_name, field_name in self._fetchall(): tables_fields.setdefault(table_name, []).append(field_name)
+        return tables_fields
 
-    def _integrity_check(self):
+    def _get_tables_formats(self, tables_names):  # format version is increased by every column change of table, restore (gbak) resets it but changes creation date
+        query = f'''
+            SELECT TRIM(RDB$RELATIONS.RDB$RELATION_NAME), RDB$RELATIONS.RDB$FORMAT, CAST(MON$DATABASE.MON$CREATION_DATE AS VARCHAR(24))
+            FROM RDB$RELATIONS CROSS JOIN MON$DATABASE
+            WHERE RDB$RELATIONS.RDB$RELATION_NAME IN ({TO_MRP_PLACEHOLDERS(tables_names)}) ORDER BY RDB$RELATIONS.RDB$RELATION_NAME
+        '''
+        self._execute(query, tables_names)
+        return get_hash(self._fetchall())
+
+    def _integrity_check(self, force=False):  # skipped while formats of tables (and database creation date) match those of last successful check
+        tables_names = list(MRP_INTEGRITY_CHECK_TABLES)
+        fingerprint = get_hash(sorted((table_name, sorted(table_fields)) for table_name, table_fields in MRP_INTEGRITY_CHECK_TABLES.items()))
+        tables_formats = self._get_tables_formats(tables_names)
+        if not force and self.store.get_schema(self._mrp_connection.database) == (tables_formats, fingerprint):
+            logger.info('MRP integrity check skipped, tables formats unchanged')
+            return
         logger.info('Starting MRP integrity check')
+        tables_fields = self._get_tables_fields(tables_names)
         for table_name, table_fields in MRP_INTEGRITY_CHECK_TABLES.items():
-            fields_diff = list(set(self._get_table_fields(table_name)).symmetric_difference(set(table_fields)))
+            fields_diff = list(set(tables_fields.get(table_name, [])).symmetric_difference(set(table_fields)))
             if fields_diff:
                 raise MrpIntegrityError(f'{table_name} table structure changed, symmetric diff: {fields_diff}')
             logger.info('%s table structure OK', table_name)
+        fingerprint = get_hash(sorted((table_name, sorted(tables_fields[table_name])) for table_name in tables_names))  # same as expected here
+        self.store.set_schema(self._mrp_connection.database, tables_formats, fingerprint)
+
+    #
+    # IDS
+    #
+    def create_ids_table(self):  # once per database, DDL is committed
+        self._check_writable('create_ids_table')
+        if self._has_ids_table(): return False
+        self._execute(f'''
+            CREATE GLOBAL TEMPORARY TABLE {MRP_TABLE.IDS} (
+                {MRP_IDS.BATCH} INTEGER NOT NULL,
+                {MRP_IDS.ID} BIGINT,
+                {MRP_IDS.VALUE} VARCHAR(40)
+            ) ON COMMIT DELETE ROWS
+        ''')
+        self._execute(f'CREATE INDEX {MRP_TABLE.IDS}_{MRP_IDS.ID} ON {MRP_TABLE.IDS} ({MRP_IDS.BATCH}, {MRP_IDS.ID})')
+        self._execute(f'CREATE INDEX {MRP_TABLE.IDS}_{MRP_IDS.VALUE} ON {MRP_TABLE.IDS} ({MRP_IDS.BATCH}, {MRP_IDS.VALUE})')
+        self.connection.commit()
+        self._begin()
+        self._mrp_connection.has_ids_table = True
+        return True
+
+    def _has_ids_table(self):
+        if self._mrp_connection.has_ids_table is None:
+            self._execute('SELECT COUNT(*) FROM RDB$RELATIONS WHERE RDB$RELATION_NAME = ?', (MRP_TABLE.IDS,))
+            self._mrp_connection.has_ids_table = bool(self._fetchone())
+        return self._mrp_connection.has_ids_table
+
+    def _load_ids(self, ids, text=False):  # returns batch of MRP_TABLE.IDS, one query per MRP_IDS_TABLE_LOAD_SIZE characters
+        batch = next(self._ids_batches)
+        column = MRP_IDS.VALUE if text else MRP_IDS.ID
+        query = f'''
+            EXECUTE BLOCK (IDS_BATCH INTEGER = ?, IDS VARCHAR({MRP_IDS_TABLE_LOAD_SIZE + 40}) = ?) AS
+                DECLARE POS INTEGER = 1;
+                DECLARE NEXT_POS INTEGER;
+            BEGIN
+                WHILE (POS <= CHAR_LENGTH(IDS)) DO BEGIN
+                    NEXT_POS = POSITION(',', IDS, POS);
+                    IF (NEXT_POS = 0) THEN NEXT_POS = CHAR_LENGTH(IDS) + 1;
+                    INSERT INTO {MRP_TABLE.IDS} ({MRP_IDS.BATCH}, {column}) VALUES (:IDS_BATCH, SUBSTRING(IDS FROM POS FOR NEXT_POS - POS));
+                    POS = NEXT_POS + 1;
+                END
+            END
+        '''
+        values, size = [], 0
+        for value in map(str, ids):
+            if text and ',' in value: raise ValueError(f'Value {value} cannot be loaded to {MRP_TABLE.IDS}')
+            if values and size + len(value) > MRP_IDS_TABLE_LOAD_SIZE:
+                self._execute(query, (batch, ','.join(values)))
+                values, size = [], 0
+            values.append(value)
+            size += len(value) + 1
+        if values: self._execute(query, (batch, ','.join(values)))
+        return batch
+
+    def _iter_ids_batches(self, ids, text=False):  # (ids, MRP_TABLE.IDS batch or None), IN list chunks or one loaded batch
+        ids = sorted(set(ids))  # results ordered across chunks, duplicates would be duplicated by join
+        threshold = getattr(settings, 'MRP_IDS_TABLE_THRESHOLD', MRP_IDS_TABLE_THRESHOLD)
+        if len(ids) > threshold and self._has_ids_table():
+            yield ids, self._load_ids(ids, text)
+            return
+        for ids_chunk in create_chunks(ids, MRP_IN_CHUNK_SIZE):
+            yield ids_chunk, None
+
+    def _get_ids_filter(self, column, ids, batch, text=False):  # (join clause, where condition, params)
+        if batch: return self._get_ids_join(column, text), None, (batch,)
+        return '', f'{column} IN ({TO_MRP_PLACEHOLDERS(ids)})', ids
+
+    def _get_ids_join(self, column, text=False):  # rows of one MRP_TABLE.IDS batch, batch is its only param
+        return f'JOIN {MRP_TABLE.IDS} ON ({MRP_TABLE.IDS}.{MRP_IDS.BATCH} = ? AND {MRP_TABLE.IDS}.{MRP_IDS.VALUE if text else MRP_IDS.ID} = {column})'
+
+    def _iter_chunks(self, ids, get_chunk):  # get_chunk(mrp_service, ids chunk, batch) for each chunk, results in order
+        batches = self._iter_ids_batches(ids)
+        if self.parallel > 1: batches = list(batches)
+        mrp_connections = self._reserve_connections(min(self.parallel, len(batches))) if self.parallel > 1 and len(batches) > 1 else []
+        if len(mrp_connections) < 2:  # one loaded MRP_TABLE.IDS batch is a single query already, or no free connections
+            self._release_connections(mrp_connections)
+            for ids_chunk, batch in batches: yield from get_chunk(self, ids_chunk, batch)
+            return
+        logger.debug('Running %d chunks in %d connections', len(batches), len(mrp_connections))
+        free_connections = Queue()
+        for mrp_connection in mrp_connections: free_connections.put(mrp_connection)
+        try:
+            with ThreadPoolExecutor(max_workers=len(mrp_connections), thread_name_prefix='mrp') as executor:
+                futures = [executor.submit(self._run_chunk, get_chunk, ids_chunk, free_connections, self._caller) for ids_chunk, _ in batches]
+                for future in futures:
+                    results, queries_count = future.result()
+                    self.queries_count += queries_count
+                    yield from results
+        finally:
+            self._release_connections(mrp_connections)
+
+    def _reserve_connections(self, count):  # up to count connections free right now, never waits for pool (other services may hold it)
+        pool = MrpConnectionPool.get(self._mrp_connection.database)
+        mrp_connections = []
+        try:
+            while len(mrp_connections) < count: mrp_connections.append(pool.borrow(timeout=0))
+        except MrpConnectionPoolError:
+            pass
+        return mrp_connections
+
+    def _release_connections(self, mrp_connections):
+        for mrp_connection in mrp_connections: MrpConnectionPool.get(mrp_connection.database).release(mrp_connection)
+
+    def _run_chunk(self, get_chunk, ids_chunk, free_connections, caller):  # own transaction on reserved connection, committed snapshot may differ from ours
+        mrp_connection = free_connections.get()
+        mrp_service = MrpService(self.mrp_year, pooled=self.pooled, fetch_batch_size=self.fetch_batch_size, store=self._store, cache=self.cache, read_only=self.read_only)
+        mrp_service._mrp_connection, mrp_service.connection, mrp_service.cursor = mrp_connection, mrp_connection.connection, mrp_connection.cursor
+        mrp_service._caller = caller
+        try:
+            mrp_service._begin()
+            return get_chunk(mrp_service, ids_chunk, None), mrp_service.queries_count
+        finally:
+            mrp_service._record_queries()
+            try:
+                mrp_connection.connection.rollback()  # reads only, connection is returned to pool after all chunks
+            finally:
+                free_connections.put(mrp_connection)
+
+    #
+    # CACHE
+    #
+    def _get_cached(self, name, ids, get_missing):  # get_missing(ids) returns list of dicts with ID or dict id: value
+        ids = list(dict.fromkeys(ids))
+        results = self.cache.get_many(self.mrp_year, name, ids)
+        missing = [mrp_id for mrp_id in ids if mrp_id not in results]
+        logger.debug('Cached %s: %d hits, %d misses', name, len(results), len(missing))
+        if missing:
+            values = get_missing(missing)
+            if isinstance(values, list): values = {value['ID']: value for value in values}
+            self.cache.set_many(self.mrp_year, name, values)
+            results.update(values)
+        return results  # id: value
+
+    def refresh_cache(self):  # invalidates entries changed since last refresh, call periodically (first call drops all)
+        if not self.cache: return
+        self.cache.refresh(self.mrp_year, 'categories', dict(self.get_categories_states(stream=True)))
+        self.cache.refresh(self.mrp_year, 'groups', self._get_product_groups(None))  # name is its version
+        self.refresh_ico_index([MRP_TABLE.USER])  # UPDCNT diff, ICOs fetched for changed rows only
+        versions = {user[0]: user[1:] for user in self.store.get_ico_index_versions(self._mrp_connection.database, MRP_TABLE.USER)}  # ICO in version, user moved to other ICO changes both
+        changed = self.cache.refresh(self.mrp_year, 'users', versions)
+        if changed is None: changed = {mrp_user_id: (version, None) for mrp_user_id, version in versions.items()}
+        mrp_company_id_numbers = {version[1] for versions_pair in changed.values() for version in versions_pair if version}
+        if mrp_company_id_numbers: self.cache.invalidate(self.mrp_year, 'users_ico', mrp_company_id_numbers)
+
+    #
+    # ICO INDEX
+    #
+    def refresh_ico_index(self, tables_names=None):  # reindexes rows added, edited or removed since last refresh (by UPDCNT), scans table, call periodically (first call builds index)
+        for table_name in tables_names or MRP_ICO_INDEX_TABLES:
+            ID, UPDATE_COUNT, _ = MRP_ICO_INDEX_TABLES[table_name]
+            self._execute(f'SELECT {table_name}.{ID}, {table_name}.{UPDATE_COUNT} FROM {table_name}')  # no expression, narrow rows
+            changed_ids = self.store.diff_ico_index(self._mrp_connection.database, table_name, self._fetchall())
+            logger.debug('Reindexing ICO of %d %s rows', len(changed_ids), table_name)
+            for ids_chunk, batch in self._iter_ids_batches(changed_ids):
+                join_clause, where_clause, params = self._get_ids_filter(f'{table_name}.{ID}', ids_chunk, batch)
+                self._index_icos(table_name, f'{join_clause} WHERE {where_clause}', params)
+            self._ico_index_refreshed.add(table_name)
+
+    def _use_ico_index(self, table_name):  # rows added since last refresh indexed once per service (primary key range), edits and removals wait for refresh_ico_index
+        if not self.ico_index: return False
+        if table_name in self._ico_index_refreshed: return True
+        max_id = self.store.get_ico_index_max_id(self._mrp_connection.database, table_name)
+        if max_id is None:
+            logger.debug('ICO index of %s not built (refresh_ico_index), querying MRP', table_name)
+            return False
+        ID = MRP_ICO_INDEX_TABLES[table_name][0]
+        self._index_icos(table_name, f'WHERE {table_name}.{ID} > ?', (max_id,))
+        self._ico_index_refreshed.add(table_name)
+        return True
+
+    def _index_icos(self, table_name, where_clause, params):
+        ID, UPDATE_COUNT, COMPANY_ID_NUMBER = MRP_ICO_INDEX_TABLES[table_name]
+        self._execute(f'''
+            SELECT
+                {table_name}.{ID},
+                {table_name}.{UPDATE_COUNT},
+                REPLACE(TRIM({table_name}.{COMPANY_ID_NUMBER}), ' ', '')
+            FROM
+                {table_name}
+            { where_clause }
+        ''', params)
+        rows = self._fetchall()
+        if rows: self.store.set_ico_index(self._mrp_connection.database, table_name, rows)
+
+    def _get_ico_index_ids(self, table_name, mrp_company_id_numbers):  # {ICO: [ids]}, key lookups instead of scans, see _use_ico_index
+        return self.store.get_ico_index_ids(self._mrp_connection.database, table_name, mrp_company_id_numbers)
+
+    #
+    # STATES
+    #
+    def diff_states(self, mrp_table, commit=True):
+        get_states = {
+            MRP_TABLE.INVOICE: self.get_invoices_states,
+            MRP_TABLE.PRODUCT: self.get_products_states,
+            MRP_TABLE.PRODUCT_CATEGORY: self.get_categories_states,
+            MRP_TABLE.USER: self.get_users_states,
+        }.get(mrp_table)
+        if not get_states: raise ValueError(f'{mrp_table} table has no states')
+        return self.store.diff_states(self.mrp_year, mrp_table, get_states(stream=True), commit=commit)
 
     #
     # CASH REGISTER
     #
-    def get_cash_register_records_by_date(self, mrp_date):
-        cash_register_records = []
+    def get_cash_register_records_by_date(self, mrp_date, records=True):  # records=False skips list of records
+        where_clause = f'{MRP_CASH_REGISTER_PAYMENT.DATE} = ?'
+        cash_register_records = [] if records else None
+        total_amount, card_amount, cash_amount, discount_amount = 0, 0, 0, 0
+        cashiers_stats = Counter()
+        for _, cash_register_record in self._iter_cash_register_records(where_clause, (mrp_date,)):  # single pass
+            total_amount += cash_register_record['AMOUNT']
+            card_amount += cash_register_record['CARD']
+            cash_amount += cash_register_record['CASH']
+            discount_amount += cash_register_record['DISCOUNT']
+            if not cash_register_record['IS_REFUND']: cashiers_stats[cash_register_record['CASHIER']] += 1  # drop refunds
+            if records: cash_register_records.append(cash_register_record)
+        return {
+            'CASH_REGISTER_RECORDS': cash_register_records,
+            'CARD_AMOUNT': card_amount,
+            'CASH_AMOUNT': cash_amount,
+            'DISCOUNT_AMOUNT': discount_amount,
+            'TOTAL_AMOUNT': total_amount,
+            'CUSTOMERS': sum(cashiers_stats.values()),
+            'CASHIERS_STATS': dict(cashiers_stats),
+        }
+
+    def _iter_cash_register_records(self, where_clause, params):
         query = f'''
             SELECT
                 {MRP_CASH_REGISTER_PAYMENT.ID} AS ID,
                 {MRP_CASH_REGISTER_PAYMENT.AMOUNT} AS AMOUNT,
                 {MRP_CASH_REGISTER_PAYMENT.DATETIME} AS DATETIME,
                 {MRP_CASH_REGISTER_PAYMENT.RAW_DATA} AS RAW_DATA,
-                TRIM({MRP_CASH_REGISTER_PAYMENT.IS_REFUND}) AS IS_REFUND
+                TRIM({MRP_CASH_REGISTER_PAYMENT.IS_REFUND}) AS IS_REFUND,
+                {MRP_CASH_REGISTER_PAYMENT.DATE} AS "DATE"
             FROM
                 {MRP_TABLE.CASH_REGISTER_PAYMENT}
             WHERE
-                {MRP_CASH_REGISTER_PAYMENT.DATE} = '{mrp_date}'
+                {where_clause}
         '''
-        self._execute(query)
-        for cash_register_record in self._fetchallmap():
-            raw_data = json_loads(cash_register_record.pop('RAW_DATA'))['ReceiptData']
-            cash_register_record.update({
-                'DISCOUNT': parse_price(0),
-                'CASHIER': raw_data['Custom']['Cashier'],
-                'CARD': parse_price(raw_data['Custom'].get('PaymentCard', 0)),
-                'CASH': parse_price(raw_data['Custom'].get('PaymentCash', 0)),
-                'IS_REFUND': bool(cash_register_record['IS_REFUND']),
-                'VARIABLE_SYMBOL': raw_data.get('InvoiceNumber', '')
-            })
-            if raw_data['ReceiptType'] == 'PD':
-                cash_register_record['DISCOUNT'] = parse_price(sum([item['Price'] for item in raw_data['Items'] if item['ItemType'] == 'Z']))
-            cash_register_records.append(cash_register_record)
-        total_amount = sum([r['AMOUNT'] for r in cash_register_records])
-        card_amount = sum([r['CARD'] for r in cash_register_records])
-        cash_amount = sum([r['CASH'] for r in cash_register_records])
-        cashiers_stats = dict(Counter([r['CASHIER'] for r in cash_register_records if not r['IS_REFUND']]))  # drop refunds
-        discount_amount = sum([r['DISCOUNT'] for r in cash_register_records])
+        no_discount = parse_price(0)
+        for mrp_id, amount, mrp_datetime, raw_data, is_refund, mrp_date in self._iterquery(query, params):
+            raw_data = TO_MRP_RECEIPT_DATA(raw_data)
+            custom = raw_data['Custom']
+            discount = no_discount
+            if raw_data['ReceiptType'] == 'PD':  # items are read for discount receipts only
+                discount = parse_price(sum([item['Price'] for item in raw_data['Items'] if item['ItemType'] == 'Z']))
+            yield mrp_date, {
+                'ID': mrp_id,
+                'AMOUNT': amount,
+                'DATETIME': mrp_datetime,
+                'IS_REFUND': bool(is_refund),
+                'DISCOUNT': discount,
+                'CASHIER': custom['Cashier'],
+                'CARD': parse_price(custom.get('PaymentCard', 0)),
+                'CASH': parse_price(custom.get('PaymentCash', 0)),
+                'VARIABLE_SYMBOL': raw_data.get('InvoiceNumber', ''),
+            }
+
+    def get_cash_register_report(self, mrp_date_from, mrp_date_to):  # per day and cashier, past days cached in store
+        mrp_dates = [mrp_date_from + timedelta(days=days) for days in range((mrp_date_to - mrp_date_from).days + 1)]
+        today = timezone.localdate()
+        summaries = self.store.get_cash_register_days(self._mrp_connection.database, [mrp_date for mrp_date in mrp_dates if mrp_date < today])
+        missing_dates = [mrp_date for mrp_date in mrp_dates if mrp_date not in summaries]
+        logger.debug('Cash register days cached: %d, computing: %d', len(summaries), len(missing_dates))
+        if missing_dates:
+            missing_summaries = {mrp_date: self._get_cash_register_summary() for mrp_date in missing_dates}
+            where_clause = f'{MRP_CASH_REGISTER_PAYMENT.DATE} BETWEEN ? AND ?'
+            for mrp_date, cash_register_record in self._iter_cash_register_records(where_clause, (missing_dates[0], missing_dates[-1])):
+                if mrp_date in missing_summaries: self._add_cash_register_record(missing_summaries[mrp_date], cash_register_record)
+            self.store.set_cash_register_days(self._mrp_connection.database, {mrp_date: summary for mrp_date, summary in missing_summaries.items() if mrp_date < today})
+            summaries.update(missing_summaries)
+        report = self._get_cash_register_summary()
+        for mrp_date in mrp_dates: self._add_cash_register_summary(report, summaries[mrp_date])
+        report['DAYS'] = {mrp_date: summaries[mrp_date] for mrp_date in mrp_dates}
+        return report
+
+    def _get_cash_register_summary(self):
         return {
-            'CASH_REGISTER_RECORDS': cash_register_records,
-            'CARD_AMOUNT': card_amount,
-            'CASH_AMOUNT': cash_amount,
-            'DISCOUNT_AMOUNT': discount_amount,
-            'TOTAL_AMOUNT': total_amount,
-            'CUSTOMERS': sum(cashiers_stats.values()),
-            'CASHIERS_STATS': cashiers_stats,
+            'CARD_AMOUNT': 0,
+            'CASH_AMOUNT': 0,
+            'DISCOUNT_AMOUNT': 0,
+            'TOTAL_AMOUNT': 0,
+            'CUSTOMERS': 0,  # refunds dropped
+            'CASHIERS': {},  # cashier: summary without CASHIERS
         }
 
+    def _add_cash_register_record(self, summary, cash_register_record):
+        cashier_summary = summary['CASHIERS'].get(cash_register_record['CASHIER'])
+        if not cashier_summary:
+            cashier_summary = summary['CASHIERS'][cash_register_record['CASHIER']] = self._get_cash_register_summary()
+            del cashier_summary['CASHIERS']
+        for target in (summary, cashier_summary):
+            target['CARD_AMOUNT'] += cash_register_record['CARD']
+            target['CASH_AMOUNT'] += cash_register_record['CASH']
+            target['DISCOUNT_AMOUNT'] += cash_register_record['DISCOUNT']
+            target['TOTAL_AMOUNT'] += cash_register_record['AMOUNT']
+            if not cash_register_record['IS_REFUND']: target['CUSTOMERS'] += 1
+
+    def _add_cash_register_summary(self, summary, added_summary):
+        for key in ('CARD_AMOUNT', 'CASH_AMOUNT', 'DISCOUNT_AMOUNT', 'TOTAL_AMOUNT', 'CUSTOMERS'): summary[key] += added_summary[key]
+        for cashier, added_cashier_summary in added_summary['CASHIERS'].items():
+            cashier_summary = summary['CASHIERS'].setdefault(cashier, {key: 0 for key in added_cashier_summary})
+            for key, value in added_cashier_summary.items(): cashier_summary[key] += value
+
     #
     # HELPERS
     #
@@ -343,18 +1531,26 @@ class MrpService:
             FROM
                 {MRP_TABLE.STOCK_MOVEMENT}
             WHERE
-                {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.DATE} = '{mrp_date}'
+                {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.DATE} = ?
                 AND {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER} IN {MRP_STOCK_MOVEMENT_NUMBERS}
             GROUP BY
                 REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', '')
         '''
-        self._execute(query)
+        self._execute(query, (mrp_date,))
         return list(filter(None, self._fetchall()))
 
     #
     # INVOICES
     #
     def add_invoice_payment(self, mrp_invoice_id, mrp_paid_amount, mrp_payment_date):
+        return self.add_invoice_payments([(mrp_invoice_id, mrp_paid_amount, mrp_payment_date)])[mrp_invoice_id]
+
+    def add_invoice_payments(self, mrp_payments):
+        self._check_writable('add_invoice_payments')
+        mrp_payments = list(mrp_payments)  # [(mrp_invoice_id, mrp_paid_amount, mrp_payment_date)]
+        mrp_invoices_ids = [mrp_invoice_id for mrp_invoice_id, _, _ in mrp_payments]
+        if len(set(mrp_invoices_ids)) != len(mrp_invoices_ids): raise ValueError('Only one payment per invoice is allowed in a batch')
+        if not mrp_payments: return {}
         query = f'''
             INSERT INTO {MRP_TABLE.INVOICE_PAYMENT} (
                 {MRP_INVOICE_PAYMENT.ID},
@@ -369,22 +1565,43 @@ class MrpService:
                 {MRP_INVOICE_PAYMENT.LOG_USER}
             )
             VALUES (
-                (SELECT MAX({MRP_INVOICE_PAYMENT.ID}) FROM {MRP_TABLE.INVOICE_PAYMENT}) + 1,
-                {mrp_invoice_id},
+                ?,
+                ?,
                 {MRP_INVOICE_PAYMENT_BANK_ID},
-                {mrp_paid_amount},
-                {mrp_paid_amount},
-                {mrp_paid_amount},
-                '{mrp_payment_date}',
+                ?,
+                ?,
+                ?,
+                ?,
                 {MRP_INVOICE_PAYMENT_METHOD},
                 '{MRP_INVOICE_PAYMENT_CURRENCY}',
                 '{MRP_INVOICE_PAYMENT_LOG_USER}'
             )
-            RETURNING
-                {MRP_INVOICE_PAYMENT.ID}
         '''
-        self._execute(query)
-        return self._fetchone()
+        for attempt in range(1, MRP_INVOICE_PAYMENT_INSERT_ATTEMPTS + 1):
+            first_id = self._get_next_invoice_payment_id()  # block first_id .. first_id + len - 1
+            self.connection.savepoint('MRP_INVOICE_PAYMENTS')
+            try:
+                self._executemany(query, [
+                    (first_id + i, mrp_invoice_id, mrp_paid_amount, mrp_paid_amount, mrp_paid_amount, mrp_payment_date)
+                    for i, (mrp_invoice_id, mrp_paid_amount, mrp_payment_date) in enumerate(mrp_payments)
+                ])
+            except fdb.DatabaseError as e:
+                self.connection.rollback(savepoint='MRP_INVOICE_PAYMENTS')
+                if len(e.args) < 3 or (e.args[1] != MRP_UNIQUE_KEY_VIOLATION_SQLCODE and e.args[2] != MRP_UNIQUE_KEY_VIOLATION_GDSCODE): raise
+                logger.warning('Invoice payments IDs %d+ taken (attempt %d/%d)', first_id, attempt, MRP_INVOICE_PAYMENT_INSERT_ATTEMPTS)
+                if attempt == MRP_INVOICE_PAYMENT_INSERT_ATTEMPTS: raise
+                continue
+            return {mrp_invoice_id: first_id + i for i, mrp_invoice_id in enumerate(mrp_invoices_ids)}
+
+    def _get_next_invoice_payment_id(self):  # MAX of last committed IDs in own read committed transaction, not of (snapshot) main one
+        transaction = self.connection.trans(default_tpb=fdb.ISOLATION_LEVEL_READ_COMMITED_RO)
+        try:
+            cursor = transaction.cursor()
+            cursor.execute(f'SELECT MAX({MRP_INVOICE_PAYMENT.ID}) FROM {MRP_TABLE.INVOICE_PAYMENT}')
+            self.queries_count += 1
+            return (cursor.fetchone()[0] or 0) + 1
+        finally:
+            transaction.close()
 
     def get_exposure_by_date(self, mrp_date):
         # TODO: subtract current overpayments
@@ -393,8 +1610,8 @@ class MrpService:
                 1,
                 COUNT(1) AS INVOICES,
                 SUM(TOTAL) AS EXPOSURE,
-                SUM(CASE WHEN DUE_DATE < '{mrp_date}' THEN 1 ELSE 0 END) AS OVERDUE_INVOICES,
-                SUM(CASE WHEN DUE_DATE < '{mrp_date}' THEN TOTAL ELSE 0 END) AS OVERDUE_EXPOSURE
+                SUM(CASE WHEN DUE_DATE < CAST(? AS DATE) THEN 1 ELSE 0 END) AS OVERDUE_INVOICES,
+                SUM(CASE WHEN DUE_DATE < CAST(? AS DATE) THEN TOTAL ELSE 0 END) AS OVERDUE_EXPOSURE
             FROM (
                 SELECT
                     CASE
@@ -409,21 +1626,96 @@ class MrpService:
                 WHERE
                     {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} != 0
                     AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} LIKE '{MRP_INVOICE_VARIABLE_SYMBOL_REGEXP}'
-                    AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} <= '{mrp_date}'
+                    AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} <= ?
                 GROUP BY
                     {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID},
                     {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE},
                     {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL}
                 HAVING
-                    (COALESCE(MAX({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}), '2030-01-01') > '{mrp_date}'
+                    (COALESCE(MAX({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}), '2030-01-01') > CAST(? AS DATE)
                         AND COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), {MRP_INVOICE_MAX_CREDIT_NOTE_VALUE}) <= {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL})
                     OR COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), -1000) < {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL}
             ) GROUP BY 1
         '''
-        self._execute(query)
+        self._execute(query, (mrp_date,) * 4)
         return self._fetchonemap()
 
-    def _get_invoices_base(self, where_clause=None, having_clause=None):
+    def get_exposure_series(self, mrp_date_from, mrp_date_to, step=1):  # every step days, unpaid rest as of each date (not current rest)
+        if step < 1: raise ValueError(f'Exposure series step must be at least 1 day, not {step}')
+        query = f'''
+            SELECT
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID} AS ID,
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} AS ISSUE_DATE,
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE} AS DUE_DATE,
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} AS TOTAL,
+                {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE} AS PAYMENT_DATE,
+                {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT} AS PAYMENT_AMOUNT
+            FROM
+                {MRP_TABLE.INVOICE}
+                LEFT JOIN {MRP_TABLE.INVOICE_PAYMENT} ON ({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID})
+            WHERE
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} != 0
+                AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} LIKE '{MRP_INVOICE_VARIABLE_SYMBOL_REGEXP}'
+                AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} <= ?
+                AND ({MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} < 0 OR COALESCE((
+                    SELECT
+                        SUM(PAID_PAYMENT.{MRP_INVOICE_PAYMENT.AMOUNT})
+                    FROM
+                        {MRP_TABLE.INVOICE_PAYMENT} PAID_PAYMENT
+                    WHERE
+                        PAID_PAYMENT.{MRP_INVOICE_PAYMENT.INVOICE_ID} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID}
+                        AND PAID_PAYMENT.{MRP_INVOICE_PAYMENT.DATE} < ?
+                ), 0) < {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL})
+            ORDER BY
+                {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID}
+        '''  # credit notes and invoices not paid before mrp_date_from (same filter as get_exposure_by_date), one row per payment
+        events = []  # (date, bucket, invoices delta, exposure delta), bucket 0 = not overdue, 1.. = MRP_EXPOSURE_AGING
+        for _, invoice_rows in groupby(self._iterquery(query, (mrp_date_to, mrp_date_from), mapped=True), key=lambda row: row['ID']):
+            self._add_exposure_events(events, list(invoice_rows))
+        events.sort(key=lambda event: event[0])
+        buckets = [[0, parse_price(0)] for _ in range(len(MRP_EXPOSURE_AGING) + 1)]  # [invoices, exposure]
+        series = []
+        i = 0
+        mrp_date = mrp_date_from
+        while mrp_date <= mrp_date_to:
+            while i < len(events) and events[i][0] <= mrp_date:
+                _, bucket, invoices, exposure = events[i]
+                buckets[bucket][0] += invoices
+                buckets[bucket][1] += exposure
+                i += 1
+            point = {
+                'DATE': mrp_date,
+                'INVOICES': sum(b[0] for b in buckets),
+                'EXPOSURE': sum(b[1] for b in buckets),
+                'OVERDUE_INVOICES': sum(b[0] for b in buckets[1:]),
+                'OVERDUE_EXPOSURE': sum(b[1] for b in buckets[1:]),
+            }
+            for (name, _), (_, exposure) in zip(MRP_EXPOSURE_AGING, buckets[1:]): point[name] = exposure
+            series.append(point)
+            mrp_date += timedelta(days=step)
+        return series
+
+    def _add_exposure_events(self, events, invoice_rows):  # changes of invoice's unpaid rest and aging bucket, as deltas
+        invoice = invoice_rows[0]
+        payments = sorted((row['PAYMENT_DATE'], row['PAYMENT_AMOUNT']) for row in invoice_rows if row['PAYMENT_DATE'])
+        aging_dates = [invoice['DUE_DATE'] + timedelta(days=days) for _, days in MRP_EXPOSURE_AGING] if invoice['DUE_DATE'] else []
+        changes_dates = sorted({invoice['ISSUE_DATE'], *[d for d in aging_dates if d > invoice['ISSUE_DATE']], *[p[0] for p in payments if p[0] > invoice['ISSUE_DATE']]})
+        paid = 0
+        i = 0
+        previous_bucket, previous_rest = 0, 0
+        for mrp_date in changes_dates:
+            while i < len(payments) and payments[i][0] <= mrp_date:
+                paid += payments[i][1]
+                i += 1
+            if invoice['TOTAL'] < 0 and not i: rest = invoice['TOTAL'] if invoice['TOTAL'] >= MRP_INVOICE_MAX_CREDIT_NOTE_VALUE else 0  # unpaid credit note lowers exposure
+            else: rest = max(invoice['TOTAL'] - paid, 0)  # refunded credit note only when refunded more, as in get_exposure_by_date
+            bucket = bisect_right(aging_dates, mrp_date)
+            if (bucket, rest) == (previous_bucket, previous_rest): continue
+            if previous_rest: events.append((mrp_date, previous_bucket, -1, -previous_rest))
+            if rest: events.append((mrp_date, bucket, 1, rest))
+            previous_bucket, previous_rest = bucket, rest
+
+    def _get_invoices_base(self, where_clause=None, having_clause=None, params=None, stream=False, join_clause=None):
         WHERE = f''
         HAVING = f''
         if where_clause: WHERE += f' WHERE {where_clause}'
@@ -458,6 +1750,7 @@ class MrpService:
                 TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.PAYMENT_METHOD}) AS PAYMENT_METHOD
             FROM
                 {MRP_TABLE.INVOICE}
+                { join_clause or '' }
                 LEFT JOIN {MRP_TABLE.USER} ON ({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.COMPANY_ID_NUMBER})
                 LEFT JOIN {MRP_TABLE.INVOICE_PAYMENT} ON ({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID})
             { WHERE }
@@ -480,8 +1773,19 @@ class MrpService:
             ORDER BY
                 {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} ASC
         '''
-        self._execute(query)
-        invoices = self._fetchallmap()
+        if stream: return self._iter_invoices_base(query, params)
+        self._execute(query, params)
+        return self._process_invoices(self._fetchallmap())
+
+    def _iter_invoices_base(self, query, params=None):
+        rows = self._iterquery(query, params, mapped=True)
+        while invoices := list(islice(rows, self.fetch_batch_size)):
+            yield from self._process_invoices(invoices)
+
+    def _process_invoices(self, invoices):
+        # TODO: paid by other invoice, info in INVOICE_ITEM table
+        paid_by_variable_symbols = {i['PAID_BY_VARIABLE_SYMBOL'] for i in invoices if i['IS_PROFORMA'] and i['PAID_BY_VARIABLE_SYMBOL']}
+        paid_by_invoices = self._get_invoices_payments_by_variable_symbols(paid_by_variable_symbols) if paid_by_variable_symbols else {}
         for invoice in invoices:
             FLAGS = []
             FLAGS_SHORT = []
@@ -493,25 +1797,8 @@ class MrpService:
             invoice['FLAGS'] = ','.join(FLAGS)
             invoice['FLAGS_SHORT'] = ','.join(FLAGS_SHORT)
             if invoice['TOTAL'] == 0: invoice['IS_PAID'] = 1  # all 0-invoices are a priori paid
-            # TODO: paid by other invoice, info in INVOICE_ITEM table
-            if invoice['IS_PROFORMA'] and invoice['PAID_BY_VARIABLE_SYMBOL']:  # (proforma) invoice paid by other invoice
-                paid_by_variable_symbol = invoice['PAID_BY_VARIABLE_SYMBOL']
-                self._execute(f'''
-                    SELECT
-                        LIST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}) AS PAYMENTS,
-                        LIST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}) AS PAYMENTS_DATES,
-                        COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), 0) AS PAYMENTS_SUM,
-                        MAX({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}) AS PAID_DATE
-                    FROM
-                        {MRP_TABLE.INVOICE_PAYMENT}
-                    WHERE
-                        {MRP_INVOICE_PAYMENT.INVOICE_ID} = (
-                            SELECT {MRP_INVOICE.ID} FROM {MRP_TABLE.INVOICE} WHERE {MRP_INVOICE.VARIABLE_SYMBOL} = '{paid_by_variable_symbol}'
-                        )
-                    GROUP BY
-                        {MRP_INVOICE_PAYMENT.INVOICE_ID}
-                ''')
-                paid_by_invoice = self._fetchonemap()
+            if invoice['IS_PROFORMA'] and invoice['PAID_BY_VARIABLE_SYMBOL'] in paid_by_invoices:  # (proforma) invoice paid by other invoice
+                paid_by_invoice = dict(paid_by_invoices[invoice['PAID_BY_VARIABLE_SYMBOL']])  # shared by proformas paid by the same invoice
                 # -- proforma invoice cannot be overpaid (will cause double overpayment!) ---
                 if paid_by_invoice['PAYMENTS_SUM'] > invoice['TOTAL']: paid_by_invoice['PAYMENTS_SUM'] = invoice['TOTAL']
                 # -- proforma invoice cannot be overpaid (will cause double overpayment) ---
@@ -524,25 +1811,130 @@ class MrpService:
                 invoice['IS_OVERPAID'] = int(bool(paid_by_invoice['PAYMENTS_SUM'] > invoice['TOTAL']))
         return invoices
 
+    def _get_invoices_payments_by_variable_symbols(self, mrp_variable_symbols):
+        payments = {}
+        mrp_variable_symbols_chunks = create_chunks(list(mrp_variable_symbols), MRP_IN_CHUNK_SIZE)
+        for mrp_variable_symbols_chunk in mrp_variable_symbols_chunks:
+            self._execute(f'''
+                SELECT
+                    TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL}) AS VARIABLE_SYMBOL,
+                    LIST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}) AS PAYMENTS,
+                    LIST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}) AS PAYMENTS_DATES,
+                    COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), 0) AS PAYMENTS_SUM,
+                    MAX({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}) AS PAID_DATE
+                FROM
+                    {MRP_TABLE.INVOICE_PAYMENT}
+                    JOIN {MRP_TABLE.INVOICE} ON ({MRP_TABLE.INVOICE}.{MRP_INVOICE.ID} = {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID})
+                WHERE
+                    {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} IN ({TO_MRP_PLACEHOLDERS(mrp_variable_symbols_chunk)})
+                GROUP BY
+                    {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID},
+                    {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL}
+            ''', mrp_variable_symbols_chunk)
+            payments.update({p.pop('VARIABLE_SYMBOL'): p for p in self._fetchallmap()})
+        return payments
+
+    def _get_invoices_summary(self, where_clause=None, having_clause=None, params=None, unpaid_only=False):
+        # totals of _get_invoices_base rows computed by firebird, same proforma rules as _process_invoices
+        WHERE = f' WHERE {where_clause}' if where_clause else ''
+        HAVING = f' HAVING {having_clause}' if having_clause else ''
+        UNPAID_ONLY = ' WHERE INVOICES.IS_PAID = 0' if unpaid_only else ''
+        query = f'''
+            SELECT
+                COUNT(*) AS INVOICES_COUNT,
+                COALESCE(SUM(CASE WHEN INVOICES.IS_PROFORMA = 0 THEN INVOICES.TOTAL ELSE 0 END), 0) AS TOTAL_AMOUNT,
+                COALESCE(SUM(INVOICES.TOTAL), 0) AS PROFORMA_TOTAL_AMOUNT,
+                COALESCE(SUM(INVOICES.MISSING), 0) AS MISSING_AMOUNT,
+                COALESCE(SUM(1 - INVOICES.IS_PAID), 0) AS MISSING_COUNT,
+                COALESCE(SUM(CASE WHEN INVOICES.IS_OVERDUE = 1 THEN INVOICES.MISSING ELSE 0 END), 0) AS OVERDUE_AMOUNT,
+                COALESCE(SUM(INVOICES.IS_OVERDUE), 0) AS OVERDUE_COUNT
+            FROM (
+                SELECT
+                    INVOICE_ROWS.TOTAL,
+                    INVOICE_ROWS.IS_PROFORMA,
+                    INVOICE_ROWS.IS_OVERDUE,
+                    CASE
+                        WHEN INVOICE_ROWS.PAID_BY_SUM IS NULL THEN INVOICE_ROWS.TOTAL - COALESCE(INVOICE_ROWS.PAYMENTS_SUM, 0)
+                        ELSE INVOICE_ROWS.TOTAL - MINVALUE(INVOICE_ROWS.PAID_BY_SUM, INVOICE_ROWS.TOTAL)
+                    END AS MISSING,
+                    CASE
+                        WHEN INVOICE_ROWS.PAID_BY_SUM IS NULL THEN (CASE WHEN INVOICE_ROWS.TOTAL = 0 OR INVOICE_ROWS.PAYMENTS_SUM >= INVOICE_ROWS.TOTAL THEN 1 ELSE 0 END)
+                        WHEN MINVALUE(INVOICE_ROWS.PAID_BY_SUM, INVOICE_ROWS.TOTAL) >= INVOICE_ROWS.TOTAL THEN 1 ELSE 0
+                    END AS IS_PAID
+                FROM (
+                    SELECT
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} AS TOTAL,
+                        SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}) AS PAYMENTS_SUM,
+                        CASE WHEN {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} LIKE '{MRP_PROFORMA_INVOICE_VARIABLE_SYMBOL_REGEXP}' THEN 1 ELSE 0 END AS IS_PROFORMA,
+                        CASE WHEN {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE} < COALESCE(MAX({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE}), CAST('NOW' AS DATE)) THEN 1 ELSE 0 END AS IS_OVERDUE,
+                        CASE
+                            WHEN {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} LIKE '{MRP_PROFORMA_INVOICE_VARIABLE_SYMBOL_REGEXP}'
+                                AND TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.PAID_BY_VARIABLE_SYMBOL}) <> '' THEN (
+                                SELECT
+                                    SUM(PAID_BY_PAYMENT.{MRP_INVOICE_PAYMENT.AMOUNT})
+                                FROM
+                                    {MRP_TABLE.INVOICE_PAYMENT} PAID_BY_PAYMENT
+                                    JOIN {MRP_TABLE.INVOICE} PAID_BY_INVOICE ON (PAID_BY_INVOICE.{MRP_INVOICE.ID} = PAID_BY_PAYMENT.{MRP_INVOICE_PAYMENT.INVOICE_ID})
+                                WHERE
+                                    PAID_BY_INVOICE.{MRP_INVOICE.VARIABLE_SYMBOL} = TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.PAID_BY_VARIABLE_SYMBOL})
+                            )
+                        END AS PAID_BY_SUM
+                    FROM
+                        {MRP_TABLE.INVOICE}
+                        LEFT JOIN {MRP_TABLE.USER} ON ({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.COMPANY_ID_NUMBER})
+                        LEFT JOIN {MRP_TABLE.INVOICE_PAYMENT} ON ({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID} = {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID})
+                    { WHERE }
+                    GROUP BY
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID},
+                        {MRP_TABLE.USER}.{MRP_USER.NAME},
+                        {MRP_TABLE.USER}.{MRP_USER.COMPANY_NAME},
+                        {MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER},
+                        {MRP_TABLE.USER}.{MRP_USER.COMPANY_TAX_ID},
+                        {MRP_TABLE.USER}.{MRP_USER.COMPANY_VAT_ID},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.PAID_BY_VARIABLE_SYMBOL},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATETIME},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.SHIPPING_METHOD},
+                        {MRP_TABLE.INVOICE}.{MRP_INVOICE.PAYMENT_METHOD}
+                    { HAVING }
+                ) INVOICE_ROWS
+            ) INVOICES
+            { UNPAID_ONLY }
+        '''  # grouped as _get_invoices_base, one row per invoice and address
+        self._execute(query, params)
+        return self._fetchonemap()
+
     def get_invoice_by_id(self, mrp_invoice_id):
         invoice = self.get_invoices_by_ids([mrp_invoice_id])
         return invoice[0] if invoice else None
 
-    def get_invoices_by_company_id_number(self, mrp_company_id_number):
+    def get_invoices_by_company_id_number(self, mrp_company_id_number, stream=False):
         where_clause = f'''
-            REPLACE(TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.COMPANY_ID_NUMBER}), ' ', '') = '{mrp_company_id_number}'
+            REPLACE(TRIM({MRP_TABLE.INVOICE}.{MRP_INVOICE.COMPANY_ID_NUMBER}), ' ', '') = ?
         '''
-        return self._get_invoices_base(where_clause=where_clause)
+        return self._get_invoices_base(where_clause=where_clause, params=(mrp_company_id_number,), stream=stream)
 
-    def get_invoices_by_date(self, mrp_date):
-        return self.get_invoices_by_date_range(mrp_date, mrp_date)
+    def get_invoices_by_date(self, mrp_date, stream=False, summary=False):
+        return self.get_invoices_by_date_range(mrp_date, mrp_date, stream, summary)
 
-    def get_invoices_by_date_range(self, mpr_date_from, mrp_date_to):
+    def get_invoices_by_date_range(self, mpr_date_from, mrp_date_to, stream=False, summary=False):  # {INVOICES, TOTAL_AMOUNT, MISSING_AMOUNT}, summary=True totals without INVOICES, stream=True iterator of invoices
         where_clause = f'''
-            {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} >= '{mpr_date_from}'
-            AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} <= '{mrp_date_to}'
+            {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} >= ?
+            AND {MRP_TABLE.INVOICE}.{MRP_INVOICE.ISSUE_DATE} <= ?
         '''
-        invoices = self._get_invoices_base(where_clause=where_clause)
+        params = (mpr_date_from, mrp_date_to)
+        if summary:  # totals only, no invoices (with stream too)
+            totals = self._get_invoices_summary(where_clause=where_clause, params=params)
+            return {
+                'INVOICES_COUNT': totals['INVOICES_COUNT'],
+                'TOTAL_AMOUNT': totals['TOTAL_AMOUNT'],
+                'MISSING_AMOUNT': totals['MISSING_AMOUNT'],
+            }
+        if stream: return self._get_invoices_base(where_clause=where_clause, params=params, stream=True)  # iterator of invoices only, totals by summary=True
+        invoices = self._get_invoices_base(where_clause=where_clause, params=params)
         total_amount = sum([i['TOTAL'] for i in invoices if not i['IS_PROFORMA']])
         missing_amount = sum([i['MISSING'] for i in invoices])
         return {
@@ -551,11 +1943,21 @@ class MrpService:
             'MISSING_AMOUNT': missing_amount,
         }
 
-    def get_invoices_by_due_date(self, mrp_date):
+    def get_invoices_by_due_date(self, mrp_date, stream=False, summary=False):  # {INVOICES, TOTAL_AMOUNT, MISSING_AMOUNT, MISSING_COUNT}, summary=True totals without INVOICES, stream=True iterator of invoices
         where_clause = f'''
-            {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE} = '{mrp_date}'
+            {MRP_TABLE.INVOICE}.{MRP_INVOICE.DUE_DATE} = ?
         '''
-        invoices = self._get_invoices_base(where_clause=where_clause)
+        params = (mrp_date,)
+        if summary:  # totals only, no invoices (with stream too)
+            totals = self._get_invoices_summary(where_clause=where_clause, params=params)
+            return {
+                'INVOICES_COUNT': totals['INVOICES_COUNT'],
+                'TOTAL_AMOUNT': totals['TOTAL_AMOUNT'],
+                'MISSING_AMOUNT': totals['MISSING_AMOUNT'],
+                'MISSING_COUNT': totals['MISSING_COUNT'],
+            }
+        if stream: return self._get_invoices_base(where_clause=where_clause, params=params, stream=True)  # iterator of invoices only, totals by summary=True
+        invoices = self._get_invoices_base(where_clause=where_clause, params=params)
         total_amount = sum([i['TOTAL'] for i in invoices if not i['IS_PROFORMA']])
         missing_amount = sum([i['MISSING'] for i in invoices])
         missing_count = len([i for i in invoices if not i['IS_PAID']])
@@ -566,33 +1968,43 @@ class MrpService:
             'MISSING_COUNT': missing_count,
         }
 
-    def get_invoices_by_ids(self, mrp_invoices_ids):
-        invoices = []
-        mrp_invoices_ids_chunks = create_chunks(mrp_invoices_ids, 250)  # firebird limit for IN is 1500
-        for mrp_invoices_ids_chunk in mrp_invoices_ids_chunks:
-            where_clause = f'''
-                {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID} IN ({', '.join(map(str, mrp_invoices_ids_chunk))})
-            '''
-            invoices += self._get_invoices_base(where_clause=where_clause)
-        return invoices
+    def get_invoices_by_ids(self, mrp_invoices_ids, stream=False):
+        invoices = self._iter_invoices_by_ids(mrp_invoices_ids)
+        return invoices if stream else list(invoices)
+
+    def _iter_invoices_by_ids(self, mrp_invoices_ids):
+        yield from self._iter_chunks(mrp_invoices_ids, MrpService._get_invoices_chunk)
 
-    def get_invoices_by_price(self, mrp_price):
+    def _get_invoices_chunk(self, mrp_invoices_ids_chunk, batch):
+        join_clause, where_clause, params = self._get_ids_filter(f'{MRP_TABLE.INVOICE}.{MRP_INVOICE.ID}', mrp_invoices_ids_chunk, batch)
+        return self._get_invoices_base(where_clause=where_clause, params=params, join_clause=join_clause)
+
+    def get_invoices_by_price(self, mrp_price, stream=False):
         where_clause = f'''
-            {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} = {mrp_price}
+            {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL} = ?
         '''
-        return self._get_invoices_base(where_clause=where_clause)
+        return self._get_invoices_base(where_clause=where_clause, params=(mrp_price,), stream=stream)
 
     def get_invoice_by_variable_symbol(self, mrp_variable_symbol):
         invoice = self.get_invoices_by_variable_symbols([mrp_variable_symbol])
         return invoice[0] if invoice else None
 
-    def get_invoices_by_variable_symbols(self, mrp_variable_symbols):
-        where_clause = f'''
-            {MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL} IN ({', '.join(map(lambda vs: f"'{vs}'", mrp_variable_symbols))})
-        '''
-        return self._get_invoices_base(where_clause=where_clause)
+    def get_invoices_by_variable_symbols(self, mrp_variable_symbols, stream=False):
+        invoices = self._iter_invoices_by_variable_symbols(mrp_variable_symbols, stream)
+        return invoices if stream else list(invoices)
+
+    def _iter_invoices_by_variable_symbols(self, mrp_variable_symbols, stream=False):
+        for mrp_variable_symbols_chunk, batch in self._iter_ids_batches(mrp_variable_symbols, text=True):
+            join_clause, where_clause, params = self._get_ids_filter(f'{MRP_TABLE.INVOICE}.{MRP_INVOICE.VARIABLE_SYMBOL}', mrp_variable_symbols_chunk, batch, text=True)
+            yield from self._get_invoices_base(where_clause=where_clause, params=params, stream=stream, join_clause=join_clause)
+
+    def get_invoices_changed_since(self, token=None):
+        return self._get_changed_since(MRP_TABLE.INVOICE, token, self.get_invoices_states(stream=True))
 
-    def get_invoices_states(self):
+    def get_invoices_states(self, stream=False):
+        return self._get_invoices_states(stream=stream)
+
+    def _get_invoices_states(self, stream=False):
         query = f'''
             SELECT
                 {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID},
@@ -607,24 +2019,17 @@ class MrpService:
                 {MRP_TABLE.INVOICE}.{MRP_INVOICE.UPDATE_COUNT},
                 {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL}
         '''
+        return self._get_states(query, 'invoices', stream=stream)
 
-        self._execute(query)
-        invoices_states = self._fetchall()
-        logger.debug('Hashing invoices states')
-        started = perf_counter()
-        results = [(s[0], get_hash(s[1:])) for s in invoices_states]  # tuple(id, hash)
-        logger.debug('Hashed in %fs', (perf_counter() - started))
-        return results
-
-    def get_paid_invoices_by_date(self, mrp_date, mrp_report_mode=False):
-        return self.get_paid_invoices_by_date_range(mrp_date, mrp_date, mrp_report_mode)
+    def get_paid_invoices_by_date(self, mrp_date, mrp_report_mode=False, stream=False, summary=False):
+        return self.get_paid_invoices_by_date_range(mrp_date, mrp_date, mrp_report_mode, stream, summary)
 
-    def get_paid_invoices_by_date_range(self, mpr_date_from, mrp_date_to, mrp_report_mode=False):
+    def get_paid_invoices_by_date_range(self, mpr_date_from, mrp_date_to, mrp_report_mode=False, stream=False, summary=False):  # {INVOICES, TOTAL_AMOUNT, MISSING_AMOUNT}, summary=True totals without INVOICES, stream=True iterator of invoices
         REPORT_MODE_CONDITNION = ''
         if mrp_report_mode:
             REPORT_MODE_CONDITNION = f'''
-                OR (CAST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATETIME} AS DATE) >= '{mpr_date_from}'
-                    AND CAST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATETIME} AS DATE) <= '{mrp_date_to}')
+                OR (CAST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATETIME} AS DATE) >= ?
+                    AND CAST({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATETIME} AS DATE) <= ?)
             '''
         where_clause = f'''
             {MRP_TABLE.INVOICE}.{MRP_INVOICE.ID} IN (
@@ -633,14 +2038,23 @@ class MrpService:
                 FROM
                     {MRP_TABLE.INVOICE_PAYMENT}
                 WHERE
-                    ({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE} >= '{mpr_date_from}'
-                    AND {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE} <= '{mrp_date_to}')
+                    ({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE} >= ?
+                    AND {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.DATE} <= ?)
                     {REPORT_MODE_CONDITNION}
                 GROUP BY
                     {MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.INVOICE_ID}
             )
         '''
-        invoices = self._get_invoices_base(where_clause=where_clause)
+        params = (mpr_date_from, mrp_date_to) * (2 if mrp_report_mode else 1)
+        if summary:  # totals only, no invoices (with stream too)
+            totals = self._get_invoices_summary(where_clause=where_clause, params=params)
+            return {
+                'INVOICES_COUNT': totals['INVOICES_COUNT'],
+                'TOTAL_AMOUNT': totals['TOTAL_AMOUNT'],
+                'MISSING_AMOUNT': totals['MISSING_AMOUNT'],
+            }
+        if stream: return self._get_invoices_base(where_clause=where_clause, params=params, stream=True)  # iterator of invoices only, totals by summary=True
+        invoices = self._get_invoices_base(where_clause=where_clause, params=params)
         total_amount = sum([i['TOTAL'] for i in invoices if not i['IS_PROFORMA']])
         missing_amount = sum([i['MISSING'] for i in invoices])
         return {
@@ -649,10 +2063,20 @@ class MrpService:
             'MISSING_AMOUNT': missing_amount,
         }
 
-    def get_unpaid_invoices(self):
+    def get_unpaid_invoices(self, stream=False, summary=False):  # {INVOICES, OVERDUE_INVOICES, TOTAL_AMOUNT, MISSING_AMOUNT, OVERDUE_AMOUNT}, summary=True totals without INVOICES, stream=True iterator of invoices
         having_clause = f'''
             COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), {MRP_INVOICE_MAX_CREDIT_NOTE_VALUE}) < {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL}
         '''
+        if summary:  # totals only, no invoices (with stream too)
+            totals = self._get_invoices_summary(having_clause=having_clause, unpaid_only=True)
+            return {
+                'INVOICES_COUNT': totals['INVOICES_COUNT'],
+                'OVERDUE_INVOICES_COUNT': totals['OVERDUE_COUNT'],
+                'TOTAL_AMOUNT': totals['PROFORMA_TOTAL_AMOUNT'],  # proforma invoices included
+                'MISSING_AMOUNT': totals['MISSING_AMOUNT'],
+                'OVERDUE_AMOUNT': totals['OVERDUE_AMOUNT'],
+            }
+        if stream: return (i for i in self._get_invoices_base(having_clause=having_clause, stream=True) if not i['IS_PAID'])  # iterator of invoices only, totals by summary=True
         invoices = [i for i in self._get_invoices_base(having_clause=having_clause) if not i['IS_PAID']]  # drop paid proforma invoices (won't be catched by SQL)
         total_amount = sum([i['TOTAL'] for i in invoices])
         missing_amount = sum([i['MISSING'] for i in invoices])
@@ -666,10 +2090,17 @@ class MrpService:
             'OVERDUE_AMOUNT': overdue_amount,
         }
 
-    def get_overpaid_invoices(self):
+    def get_overpaid_invoices(self, stream=False, summary=False):  # {INVOICES, OVERPAID_AMOUNT}, summary=True totals without INVOICES, stream=True iterator of invoices
         having_clause = f'''
             COALESCE(SUM({MRP_TABLE.INVOICE_PAYMENT}.{MRP_INVOICE_PAYMENT.AMOUNT}), {MRP_INVOICE_MAX_CREDIT_NOTE_VALUE}) > {MRP_TABLE.INVOICE}.{MRP_INVOICE.TOTAL}
         '''
+        if summary:  # totals only, no invoices (with stream too)
+            totals = self._get_invoices_summary(having_clause=having_clause)
+            return {
+                'INVOICES_COUNT': totals['INVOICES_COUNT'],
+                'OVERPAID_AMOUNT': totals['MISSING_AMOUNT'],
+            }
+        if stream: return self._get_invoices_base(having_clause=having_clause, stream=True)  # iterator of invoices only, totals by summary=True
         invoices = self._get_invoices_base(having_clause=having_clause)
         overpaid_amount = sum([i['MISSING'] for i in invoices])
         return {
@@ -680,11 +2111,77 @@ class MrpService:
     #
     # PRODUCTS
     #
+    def bulk_update_products(self, mrp_products, batch_size=MRP_PRODUCT_UPDATE_BATCH_SIZE):  # in service transaction (committed on exit), failed batch rolled back to its savepoint only
+        self._check_writable('bulk_update_products')
+        mrp_products = list(mrp_products)
+        for mrp_product in mrp_products:
+            unknown_fields = set(mrp_product) - set(MRP_PRODUCT_UPDATE_FIELDS) - {'ID'}
+            if unknown_fields: raise ValueError(f'Product fields {sorted(unknown_fields)} cannot be updated')
+        existing_ids = set(self._get_existing_products_ids([mrp_product['ID'] for mrp_product in mrp_products]))  # UPDATE of missing id does nothing
+        missing_ids = set()
+        groups = {}  # fields: [params]
+        for mrp_product in mrp_products:
+            if mrp_product['ID'] not in existing_ids:
+                missing_ids.add(mrp_product['ID'])
+                continue
+            fields = tuple(sorted(field for field in mrp_product if field != 'ID'))
+            values = {field: TO_MRP_PRODUCT_VALUE(field, mrp_product[field]) for field in fields}
+            product_fields = tuple(field for field in fields if field != 'DESCRIPTION')
+            if product_fields: groups.setdefault(product_fields, []).append([values[f] for f in product_fields] + [mrp_product['ID']])
+            if 'DESCRIPTION' in values: groups.setdefault(('DESCRIPTION',), []).append([mrp_product['ID'], values['DESCRIPTION']])
+        updated_ids = set()
+        failed_ids = set()
+        errors = []
+        for fields, params_list in groups.items():
+            if fields == ('DESCRIPTION',):
+                query = f'''
+                    UPDATE OR INSERT INTO
+                        {MRP_TABLE.PRODUCT_DETAIL} ({MRP_PRODUCT_DETAIL.PRODUCT_ID}, {MRP_PRODUCT_DETAIL.DESCRIPTION})
+                    VALUES (?, ?)
+                '''
+            else:
+                query = f'''
+                    UPDATE {MRP_TABLE.PRODUCT} SET {', '.join(f'{MRP_PRODUCT_UPDATE_FIELDS[f][0]} = ?' for f in fields)} WHERE {MRP_PRODUCT.ID} = ?
+                '''
+            for params_batch in create_chunks(params_list, batch_size):
+                mrp_products_ids = [params[0] if fields == ('DESCRIPTION',) else params[-1] for params in params_batch]
+                self.connection.savepoint(MRP_PRODUCT_UPDATE_SAVEPOINT)
+                try:
+                    self._executemany(query, params_batch)
+                except fdb.Error as e:
+                    self.connection.rollback(savepoint=MRP_PRODUCT_UPDATE_SAVEPOINT)  # rows of this batch only, earlier work of transaction kept
+                    logger.warning('Bulk update of products %s failed for %d products: %s', fields, len(params_batch), e)
+                    failed_ids.update(mrp_products_ids)
+                    errors.append({'FIELDS': fields, 'IDS': mrp_products_ids, 'ERROR': str(e)})
+                else:
+                    updated_ids.update(mrp_products_ids)
+                self.connection.execute_immediate(f'RELEASE SAVEPOINT {MRP_PRODUCT_UPDATE_SAVEPOINT}')  # undo log of batch freed
+        return {
+            'UPDATED_IDS': sorted(updated_ids - failed_ids),  # all fields written
+            'MISSING_IDS': sorted(missing_ids),  # not in MRP, nothing written
+            'ERRORS': errors,
+        }
+
+    def _get_existing_products_ids(self, mrp_products_ids):
+        existing_ids = []
+        for mrp_products_ids_chunk, batch in self._iter_ids_batches(mrp_products_ids):
+            join_clause, where_clause, params = self._get_ids_filter(f'{MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID}', mrp_products_ids_chunk, batch)
+            WHERE = f' WHERE {where_clause}' if where_clause else ''
+            self._execute(f'SELECT {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} FROM {MRP_TABLE.PRODUCT} {join_clause}{WHERE}', params)
+            existing_ids.extend(self._fetchall())
+        return existing_ids
+
     def get_category_by_id(self, mrp_category_id):
         category = self.get_categories_by_ids([mrp_category_id])
         return category[0] if category else None
 
     def get_categories_by_ids(self, mrp_categories_ids):
+        if self.cache:
+            categories = self._get_cached('categories', mrp_categories_ids, self._get_categories_by_ids)
+            return [categories[mrp_category_id] for mrp_category_id in sorted(categories)]  # ORDER BY ID
+        return self._get_categories_by_ids(mrp_categories_ids)
+
+    def _get_categories_by_ids(self, mrp_categories_ids):
         query = f'''
             SELECT
                 {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID} AS ID,
@@ -695,14 +2192,14 @@ class MrpService:
             FROM
                 {MRP_TABLE.PRODUCT_CATEGORY}
             WHERE
-                {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID} IN ({', '.join(map(str, mrp_categories_ids))})
+                {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID} IN ({TO_MRP_PLACEHOLDERS(mrp_categories_ids)})
             ORDER BY
                 {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID} ASC
         '''
-        self._execute(query)
+        self._execute(query, mrp_categories_ids)
         return self._fetchallmap()
 
-    def get_categories_states(self):
+    def get_categories_states(self, stream=False):
         query = f'''
             SELECT
                 {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID},
@@ -715,13 +2212,18 @@ class MrpService:
             ORDER BY
                 {MRP_TABLE.PRODUCT_CATEGORY}.{MRP_PRODUCT_CATEGORY.ID} ASC
         '''
+        return self._get_states(query, 'categories', stream=stream)
+
+    def _get_product_groups(self, mrp_groups_numbers):  # all groups at once, table is small
+        query = f'''
+            SELECT
+                TRIM({MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NUMBER}),
+                COALESCE(TRIM({MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NAME}), '')
+            FROM
+                {MRP_TABLE.PRODUCT_GROUP}
+        '''
         self._execute(query)
-        categories_states = self._fetchall()
-        logger.debug('Hashing categories states')
-        started = perf_counter()
-        results = [(cs[0], get_hash(cs[1:])) for cs in categories_states]  # tuple(id, hash)
-        logger.debug('Hashed in %fs', (perf_counter() - started))
-        return results
+        return dict(self._fetchall())  # number: name
 
     def get_product_by_number(self, mrp_product_number):
         query = f'''
@@ -730,9 +2232,9 @@ class MrpService:
             FROM
                 {MRP_TABLE.PRODUCT}
             WHERE
-                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER} = {mrp_product_number}
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_product_number,))
         mrp_product_id = self._fetchone()
         if not mrp_product_id: return None  # CISLO does not exist
         return self.get_product_by_id(mrp_product_id)
@@ -741,129 +2243,172 @@ class MrpService:
         product = self.get_products_by_ids([mrp_product_id])
         return product[0] if product else None
 
-    def get_products_by_ids(self, mrp_products_ids):
-        products = []
-        mrp_products_ids_chunks = create_chunks(mrp_products_ids, 250)  # firebird limit for IN is 1500
-        for mrp_products_ids_chunk in mrp_products_ids_chunks:
-            query = f'''
+    def get_products_by_ids(self, mrp_products_ids, stream=False):
+        products = self._iter_products_by_ids(mrp_products_ids)
+        return products if stream else list(products)
+
+    def _iter_products_by_ids(self, mrp_products_ids):
+        yield from self._iter_chunks(mrp_products_ids, MrpService._get_products_chunk)
+
+    def _get_products_chunk(self, mrp_products_ids_chunk, batch):
+        if self.cache:  # group number selected, its name taken from cache
+            GROUP_NAME = f'{MRP_TABLE.PRODUCT}.{MRP_PRODUCT.GROUP_NUMBER}'
+            GROUP_JOIN = ''
+        else:
+            GROUP_NAME = f'{MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NAME}'
+            GROUP_JOIN = f'LEFT JOIN {MRP_TABLE.PRODUCT_GROUP} ON ({MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NUMBER} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.GROUP_NUMBER})'
+        IDS_JOIN, ids_where, params = self._get_ids_filter(f'{MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID}', mrp_products_ids_chunk, batch)
+        IDS_WHERE = f'AND {ids_where}' if ids_where else ''
+        query = f'''
+            SELECT
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} AS ID,
+                CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER} AS INTEGER) AS NUMBER,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME}) AS NAME,
+                COALESCE(CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.CATEGORY_NUMBER} AS INTEGER), 0) AS CATEGORY_NUMBER,
+                '' AS CATEGORY_NUMBER_EX,
+                COALESCE(TRIM({GROUP_NAME}), '') AS GROUP_NAME,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.METATAGS}) AS METATAGS,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.EAN}) AS EAN,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU}) AS SKU,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS}) AS UNITS,
+                CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS_MULTIPLIER} AS INTEGER) AS UNITS_MULTIPLIER,
+                CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.VAT_PERCENT} AS INTEGER) AS VAT_PERCENT,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_FLAG}) AS ESHOP_FLAG,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_INFO}) AS ESHOP_INFO,
+                CAST(TRIM('0' || {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.WARRANTY}) AS INTEGER) AS WARRANTY,
+                COALESCE(TRIM({MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.DESCRIPTION}), '') AS DESCRIPTION,
+                COALESCE(TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ATTRIBUTES}), '') AS ATTRIBUTES,
+                MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE1}) AS PRICE1,
+                MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE2}) AS PRICE2,
+                MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE3}) AS PRICE3,
+                MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE4}) AS PRICE4,
+                MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE5}) AS PRICE5,
+                CAST(SUM({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.STOCK_QUANTITY}) AS INTEGER) AS STOCK_QUANTITY,
+                CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.STOCK_MINIMUM} AS INTEGER) AS STOCK_MINIMUM,
+                COALESCE({MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID}, 0) AS MASTER_PRODUCT_ID,
+                '' AS SLAVE_PRODUCTS_NAMES,
+                '' AS SLAVE_PRODUCTS_SKUS
+            FROM
+                {MRP_TABLE.PRODUCT}
+                { IDS_JOIN }
+                LEFT JOIN {MRP_TABLE.PRODUCT_DETAIL} ON ({MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
+                { GROUP_JOIN }
+                LEFT JOIN {MRP_TABLE.PRODUCT_ITEM} ON ({MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
+                LEFT JOIN {MRP_TABLE.PRODUCT_STATUS} ON ({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
+            WHERE
+                {MRP_PRODUCT_STATUS.STOCK_NUMBER} IN {MRP_PRODUCT_STOCK_NUMBERS}
+                { IDS_WHERE }
+            GROUP BY
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.CATEGORY_NUMBER},
+                {GROUP_NAME},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.METATAGS},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.EAN},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS_MULTIPLIER},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.VAT_PERCENT},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_FLAG},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_INFO},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.WARRANTY},
+                {MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.DESCRIPTION},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ATTRIBUTES},
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.STOCK_MINIMUM},
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID}
+            ORDER BY
+                {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} ASC
+        '''
+        self._execute(query, params)
+        products_chunk = self._fetchallmap()
+        if not products_chunk: return []
+        if self.cache:
+            groups_numbers = list({product['GROUP_NAME'] for product in products_chunk if product['GROUP_NAME']})
+            groups = self._get_cached('groups', groups_numbers, self._get_product_groups) if groups_numbers else {}
+            for product in products_chunk: product['GROUP_NAME'] = groups.get(product['GROUP_NAME'], '')
+        products_ids = [product['ID'] for product in products_chunk]
+        # EXTENDED CATEGORIES
+        IDS_JOIN, ids_where, params = self._get_ids_filter(f'{MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID}', products_ids, batch)
+        IDS_WHERE = f'WHERE {ids_where}' if ids_where else ''
+        self._execute(f'''
+            SELECT
+                {MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID} AS PRODUCT_ID,
+                COALESCE(LIST({MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.CATEGORY_NUMBER}), '') AS CATEGORY_NUMBER_EX
+            FROM
+                {MRP_TABLE.PRODUCT_CATEGORY_EX}
+                { IDS_JOIN }
+            { IDS_WHERE }
+            GROUP BY
+                {MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID}
+        ''', params)
+        extended_categories = {ec['PRODUCT_ID']: ec['CATEGORY_NUMBER_EX'] for ec in self._fetchallmap()}
+        # COMPOUNDED PRODUCT CHECK
+        IDS_JOIN, ids_where, params = self._get_ids_filter(f'{MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID}', products_ids, batch)
+        IDS_WHERE = f'WHERE {ids_where}' if ids_where else ''
+        self._execute(f'''
+            SELECT
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID} AS MASTER_PRODUCT_ID,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME}) AS SLAVE_PRODUCT_NAME,
+                TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU}) AS SLAVE_PRODUCT_SKU,
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID} AS SLAVE_PRODUCT_ID,
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_COUNT} AS SLAVE_PRODUCT_COUNT
+            FROM
+                {MRP_TABLE.PRODUCT_ITEM}
+                { IDS_JOIN }
+                LEFT JOIN {MRP_TABLE.PRODUCT} ON ({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} = {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID})
+            { IDS_WHERE }
+            ORDER BY
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID} ASC,
+                {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.ID} ASC
+        ''', params)
+        slave_products_by_master = {}
+        for slave_product in self._fetchallmap():
+            slave_products_by_master.setdefault(slave_product['MASTER_PRODUCT_ID'], []).append(slave_product)
+        # UPDATE STOCK_QUANTITY, STOCK_MINIMUM (first slave product only)
+        slave_stock_quantities = {}
+        slave_products_ids = [sps[0]['SLAVE_PRODUCT_ID'] for sps in slave_products_by_master.values()]
+        for slave_products_ids in create_chunks(slave_products_ids, MRP_IN_CHUNK_SIZE):  # more than a chunk with MRP_TABLE.IDS
+            self._execute(f'''
                 SELECT
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} AS ID,
-                    CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER} AS INTEGER) AS NUMBER,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME}) AS NAME,
-                    COALESCE(CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.CATEGORY_NUMBER} AS INTEGER), 0) AS CATEGORY_NUMBER,
-                    '' AS CATEGORY_NUMBER_EX,
-                    COALESCE(TRIM({MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NAME}), '') AS GROUP_NAME,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.METATAGS}) AS METATAGS,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.EAN}) AS EAN,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU}) AS SKU,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS}) AS UNITS,
-                    CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS_MULTIPLIER} AS INTEGER) AS UNITS_MULTIPLIER,
-                    CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.VAT_PERCENT} AS INTEGER) AS VAT_PERCENT,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_FLAG}) AS ESHOP_FLAG,
-                    TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_INFO}) AS ESHOP_INFO,
-                    CAST(TRIM('0' || {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.WARRANTY}) AS INTEGER) AS WARRANTY,
-                    COALESCE(TRIM({MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.DESCRIPTION}), '') AS DESCRIPTION,
-                    COALESCE(TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ATTRIBUTES}), '') AS ATTRIBUTES,
-                    MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE1}) AS PRICE1,
-                    MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE2}) AS PRICE2,
-                    MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE3}) AS PRICE3,
-                    MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE4}) AS PRICE4,
-                    MAX({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRICE5}) AS PRICE5,
-                    CAST(SUM({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.STOCK_QUANTITY}) AS INTEGER) AS STOCK_QUANTITY,
-                    CAST({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.STOCK_MINIMUM} AS INTEGER) AS STOCK_MINIMUM,
-                    COALESCE({MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID}, 0) AS MASTER_PRODUCT_ID,
-                    '' AS SLAVE_PRODUCTS_NAMES,
-                    '' AS SLAVE_PRODUCTS_SKUS
+                    {MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} AS PRODUCT_ID,
+                    CAST(SUM({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.STOCK_QUANTITY}) AS INTEGER) AS STOCK_QUANTITY
                 FROM
-                    {MRP_TABLE.PRODUCT}
-                    LEFT JOIN {MRP_TABLE.PRODUCT_DETAIL} ON ({MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
-                    LEFT JOIN {MRP_TABLE.PRODUCT_GROUP} ON ({MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NUMBER} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.GROUP_NUMBER})
-                    LEFT JOIN {MRP_TABLE.PRODUCT_ITEM} ON ({MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
-                    LEFT JOIN {MRP_TABLE.PRODUCT_STATUS} ON ({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
+                    {MRP_TABLE.PRODUCT_STATUS}
                 WHERE
                     {MRP_PRODUCT_STATUS.STOCK_NUMBER} IN {MRP_PRODUCT_STOCK_NUMBERS}
-                    AND {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} IN ({', '.join(map(str, mrp_products_ids_chunk))})
+                    AND {MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} IN ({TO_MRP_PLACEHOLDERS(slave_products_ids)})
                 GROUP BY
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NUMBER},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.CATEGORY_NUMBER},
-                    {MRP_TABLE.PRODUCT_GROUP}.{MRP_PRODUCT_GROUP.NAME},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.METATAGS},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.EAN},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.UNITS_MULTIPLIER},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.VAT_PERCENT},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_FLAG},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ESHOP_INFO},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.WARRANTY},
-                    {MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.DESCRIPTION},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ATTRIBUTES},
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.STOCK_MINIMUM},
-                    {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID}
-                ORDER BY
-                    {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} ASC
-            '''
-            self._execute(query)
-            products_chunk = self._fetchallmap()
-            for product in products_chunk:
-                # EXTENDED CATEGORIES
-                self._execute(f'''
-                    SELECT
-                        COALESCE(LIST({MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.CATEGORY_NUMBER}), '') AS CATEGORY_NUMBER_EX
-                    FROM
-                        {MRP_TABLE.PRODUCT_CATEGORY_EX}
-                    WHERE
-                        {MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID} = {product['ID']}
-                    GROUP BY
-                        {MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID}
-                ''')
-                extended_categories = self._fetchonemap()
-                if extended_categories: product.update(extended_categories)
-                # COMPOUNDED PRODUCT CHECK
-                master_product_id = product['ID']
-                self._execute(f'''
-                    SELECT
-                        TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.NAME}) AS SLAVE_PRODUCT_NAME,
-                        TRIM({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.SKU}) AS SLAVE_PRODUCT_SKU,
-                        {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID} AS SLAVE_PRODUCT_ID,
-                        {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_COUNT} AS SLAVE_PRODUCT_COUNT
-                    FROM
-                        {MRP_TABLE.PRODUCT_ITEM}
-                        LEFT JOIN {MRP_TABLE.PRODUCT} ON ({MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} = {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.SLAVE_PRODUCT_ID})
-                    WHERE
-                        {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.MASTER_PRODUCT_ID} = {master_product_id}
-                    ORDER BY
-                        {MRP_TABLE.PRODUCT_ITEM}.{MRP_PRODUCT_ITEM.ID} ASC
-                ''')
-                slave_products = self._fetchallmap()
-                if slave_products:
-                    product.update({
-                        'SLAVE_PRODUCTS_NAMES': '|'.join([f"{sp['SLAVE_PRODUCT_COUNT']}x - {sp['SLAVE_PRODUCT_NAME']}" for sp in slave_products]),
-                        'SLAVE_PRODUCTS_SKUS': '|'.join([f"{sp['SLAVE_PRODUCT_COUNT']}x - {sp['SLAVE_PRODUCT_SKU']}" for sp in slave_products])
-                    })
-                    # UPDATE STOCK_QUANTITY, STOCK_MINIMUM
-                    slave_product_id = slave_products[0]['SLAVE_PRODUCT_ID']
-                    self._execute(f'''
-                        SELECT 
-                            CAST(SUM({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.STOCK_QUANTITY}) AS INTEGER) AS STOCK_QUANTITY
-                        FROM
-                            {MRP_TABLE.PRODUCT_STATUS}
-                        WHERE
-                            {MRP_PRODUCT_STATUS.STOCK_NUMBER} IN {MRP_PRODUCT_STOCK_NUMBERS}
-                            AND {MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} = {slave_product_id}
-                        GROUP BY
-                            {MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID}
-                    ''')
-                    product.update(self._fetchonemap())
-            products += products_chunk
-        return products
-
-    def get_products_states(self, mrp_products_ids=None):
-        WHERE = f'''
-            WHERE {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} IN ({', '.join(map(str, mrp_products_ids))})
-        ''' if mrp_products_ids else ''
+                    {MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID}
+            ''', slave_products_ids)
+            slave_stock_quantities.update({ss['PRODUCT_ID']: ss['STOCK_QUANTITY'] for ss in self._fetchallmap()})
+        for product in products_chunk:
+            if product['ID'] in extended_categories: product['CATEGORY_NUMBER_EX'] = extended_categories[product['ID']]
+            slave_products = slave_products_by_master.get(product['ID'])
+            if slave_products:
+                product.update({
+                    'SLAVE_PRODUCTS_NAMES': '|'.join([f"{sp['SLAVE_PRODUCT_COUNT']}x - {sp['SLAVE_PRODUCT_NAME']}" for sp in slave_products]),
+                    'SLAVE_PRODUCTS_SKUS': '|'.join([f"{sp['SLAVE_PRODUCT_COUNT']}x - {sp['SLAVE_PRODUCT_SKU']}" for sp in slave_products])
+                })
+                slave_product_id = slave_products[0]['SLAVE_PRODUCT_ID']
+                if slave_product_id in slave_stock_quantities: product['STOCK_QUANTITY'] = slave_stock_quantities[slave_product_id]
+        return products_chunk
+
+    def get_products_changed_since(self, token=None):
+        return self._get_changed_since(MRP_TABLE.PRODUCT, token, self.get_products_states(stream=True))
+
+    def get_products_states(self, mrp_products_ids=None, stream=False):
+        if not mrp_products_ids: return self._get_products_states(stream=stream)
+        states = self._iter_products_states_by_ids(mrp_products_ids)
+        return states if stream else list(states)
+
+    def _iter_products_states_by_ids(self, mrp_products_ids):
+        for mrp_products_ids_chunk, batch in self._iter_ids_batches(mrp_products_ids):
+            join_clause, where_clause, params = self._get_ids_filter(f'{MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID}', mrp_products_ids_chunk, batch)
+            yield from self._get_products_states(where_clause, params, stream=True, join_clause=join_clause)
+
+    def _get_products_states(self, where_clause=None, params=None, stream=False, join_clause=None):
+        WHERE = f' WHERE {where_clause}' if where_clause else ''
         query = f'''
             SELECT
                 {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID},
@@ -881,6 +2426,7 @@ class MrpService:
                 LIST({MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.CATEGORY_NUMBER})
             FROM
                 {MRP_TABLE.PRODUCT}
+                { join_clause or '' }
                 LEFT JOIN {MRP_TABLE.PRODUCT_DETAIL} ON ({MRP_TABLE.PRODUCT_DETAIL}.{MRP_PRODUCT_DETAIL.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
                 LEFT JOIN {MRP_TABLE.PRODUCT_STATUS} ON ({MRP_TABLE.PRODUCT_STATUS}.{MRP_PRODUCT_STATUS.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
                 LEFT JOIN {MRP_TABLE.PRODUCT_CATEGORY_EX} ON ({MRP_TABLE.PRODUCT_CATEGORY_EX}.{MRP_PRODUCT_CATEGORY_EX.PRODUCT_ID} = {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID})
@@ -899,84 +2445,88 @@ class MrpService:
             ORDER BY
                 {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} ASC
         '''
-        self._execute(query)
-        products_states = self._fetchall()
-        logger.debug('Hashing products states')
-        started = perf_counter()
-        results = [(ps[0], get_hash(ps[1:])) for ps in products_states]  # tuple(id, hash)
-        logger.debug('Hashed in %fs', (perf_counter() - started))
-        return results
+        return self._get_states(query, 'products', params, stream)
 
     def set_product_attributes(self, mrp_product_id, mrp_attributes):
-        mrp_attributes = TO_MRP_NEWLINES(str(mrp_attributes))  # BLOB
+        self._check_writable('set_product_attributes')
+        mrp_attributes = TO_MRP_PRODUCT_VALUE('ATTRIBUTES', mrp_attributes)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ATTRIBUTES} = {mrp_attributes} WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ATTRIBUTES} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_attributes, mrp_product_id))
 
     def set_product_description(self, mrp_product_id, mrp_description):
-        mrp_description = TO_MRP_NEWLINES(str(mrp_description))  # BLOB
+        self._check_writable('set_product_description')
+        mrp_description = TO_MRP_PRODUCT_VALUE('DESCRIPTION', mrp_description)
         query = f'''
             UPDATE OR INSERT INTO
                 {MRP_TABLE.PRODUCT_DETAIL} ({MRP_PRODUCT_DETAIL.PRODUCT_ID}, {MRP_PRODUCT_DETAIL.DESCRIPTION})
-            VALUES ({mrp_product_id}, {mrp_description})
+            VALUES (?, ?)
         '''
-        self._execute(query)
+        self._execute(query, (mrp_product_id, mrp_description))
 
     def set_product_ean(self, mrp_product_id, mrp_ean):
-        mrp_ean = str(mrp_ean)[:25]  # CHAR(25)
+        self._check_writable('set_product_ean')
+        mrp_ean = TO_MRP_PRODUCT_VALUE('EAN', mrp_ean)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.EAN} = '{mrp_ean}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.EAN} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_ean, mrp_product_id))
 
     def set_product_eshop_flag(self, mrp_product_id, mrp_eshop_flag):
-        mrp_eshop_flag = str(mrp_eshop_flag)[:50]  # CHAR(50)
+        self._check_writable('set_product_eshop_flag')
+        mrp_eshop_flag = TO_MRP_PRODUCT_VALUE('ESHOP_FLAG', mrp_eshop_flag)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ESHOP_FLAG} = '{mrp_eshop_flag}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ESHOP_FLAG} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_eshop_flag, mrp_product_id))
 
     def set_product_eshop_info(self, mrp_product_id, mrp_eshop_info):
-        mrp_eshop_info = str(mrp_eshop_info)[:50]  # CHAR(50)
+        self._check_writable('set_product_eshop_info')
+        mrp_eshop_info = TO_MRP_PRODUCT_VALUE('ESHOP_INFO', mrp_eshop_info)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ESHOP_INFO} = '{mrp_eshop_info}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.ESHOP_INFO} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_eshop_info, mrp_product_id))
 
     def set_product_metatags(self, mrp_product_id, mrp_metatags):
-        mrp_metatags = str(mrp_metatags)[:50]  # CHAR(50)
+        self._check_writable('set_product_metatags')
+        mrp_metatags = TO_MRP_PRODUCT_VALUE('METATAGS', mrp_metatags)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.METATAGS} = '{mrp_metatags}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.METATAGS} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_metatags, mrp_product_id))
 
     def set_product_name(self, mrp_product_id, mrp_name):
-        mrp_name = str(mrp_name)[:64]  # CHAR(64)
+        self._check_writable('set_product_name')
+        mrp_name = TO_MRP_PRODUCT_VALUE('NAME', mrp_name)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.NAME} = '{mrp_name}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.NAME} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_name, mrp_product_id))
 
     def set_product_small_note(self, mrp_product_id, mrp_small_note):
-        mrp_small_note = str(mrp_small_note)[:50]  # CHAR(50)
+        self._check_writable('set_product_small_note')
+        mrp_small_note = TO_MRP_PRODUCT_VALUE('SMALL_NOTE', mrp_small_note)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.SMALL_NOTE} = '{mrp_small_note}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.SMALL_NOTE} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_small_note, mrp_product_id))
 
     def set_product_sku(self, mrp_product_id, mrp_sku):
-        mrp_sku = str(mrp_sku)[:64]  # CHAR(64)
+        self._check_writable('set_product_sku')
+        mrp_sku = TO_MRP_PRODUCT_VALUE('SKU', mrp_sku)
         query = f'''
-            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.SKU} = '{mrp_sku}' WHERE {MRP_PRODUCT.ID} = {mrp_product_id}
+            UPDATE {MRP_TABLE.PRODUCT} SET {MRP_PRODUCT.SKU} = ? WHERE {MRP_PRODUCT.ID} = ?
         '''
-        self._execute(query)
+        self._execute(query, (mrp_sku, mrp_product_id))
 
     #
     # USERS
     #
     def add_user(self, mrp_name, mrp_address, mrp_city, mrp_zip, mrp_country, mrp_country_code, mrp_phone, mrp_email, mrp_individual,
                  mrp_company_name, mrp_company_id_number, mrp_company_tax_id, mrp_company_vat_id):
+        self._check_writable('add_user')
         if not mrp_company_id_number:  # auto-generate company_id_number
             self._execute("SELECT FIRST 1 CAST(SUBSTRING(ICO FROM 2) AS INTEGER) FROM ADRES WHERE ICO LIKE 'A0%' ORDER BY ICO DESC")
             mrp_company_id_number = f'A0{self._fetchone() + 1}'
@@ -1000,29 +2550,30 @@ class MrpService:
             )
             VALUES (
                 (SELECT MAX({MRP_USER.ID}) FROM {MRP_TABLE.USER}) + 1,
-                '{mrp_name}',
-                '{mrp_address}',
-                '{mrp_city}',
-                '{mrp_zip}',
-                '{mrp_country}',
-                '{mrp_country_code}',
-                '{mrp_phone}',
-                '{mrp_email}',
-                '{mrp_individual}',
-                '{mrp_company_name}',
-                '{mrp_company_id_number}',
-                '{mrp_company_tax_id}',
-                '{mrp_company_vat_id}',
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
                 ' - BENALEXPLUS INTRANET - '
             )
             MATCHING ({MRP_USER.COMPANY_ID_NUMBER})
             RETURNING
                 {MRP_USER.ID}
         '''
-        self._execute(query)
+        self._execute(query, (
+            mrp_name, mrp_address, mrp_city, mrp_zip, mrp_country, mrp_country_code, mrp_phone, mrp_email, mrp_individual,
+            mrp_company_name, mrp_company_id_number, mrp_company_tax_id, mrp_company_vat_id
+        ))
         return self._fetchone(), mrp_company_id_number  # mrp_user_id, mrp_company_id_number
 
-    def get_users_states(self):
+    def get_users_changed_since(self, token=None):
+        return self._get_changed_since(MRP_TABLE.USER, token, self.get_users_states(stream=True))
+
+    def get_users_states(self, stream=False):
+        if not self.states_hash and self._use_ico_index(MRP_TABLE.USER):  # grouped by ICO in MrpStore, same states as query, states_hash modes need query (hashed or concatenated by firebird)
+            states = [tuple(s) for s in self.store.get_ico_index_states(self._mrp_connection.database, MRP_TABLE.USER)]
+            states = zip([s[0] for s in states], self._hash_states(states))
+            return states if stream else list(states)
+        return self._get_users_states(stream=stream)
+
+    def _get_users_states(self, stream=False):
         query = f'''
             SELECT
                 MAX({MRP_TABLE.USER}.{MRP_USER.ID}),
@@ -1033,72 +2584,86 @@ class MrpService:
             GROUP BY
                 REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '')
         '''
-        self._execute(query)
-        users_states = self._fetchall()
-        logger.debug('Hashing users states')
-        started = perf_counter()
-        results = [(us[0], get_hash(us[1:])) for us in users_states]  # tuple(id, hash)
-        logger.debug('Hashed in %fs', (perf_counter() - started))
-        return results
+        return self._get_states(query, 'users', stream=stream)
 
     def get_user_by_company_id_number(self, mrp_company_id_number):
+        if self.cache:
+            mrp_user_id = self._get_cached('users_ico', [mrp_company_id_number], self._get_users_ids_by_company_id_numbers).get(mrp_company_id_number)
+            return self.get_user_by_id(mrp_user_id) if mrp_user_id else None
+        mrp_user_id = self._get_users_ids_by_company_id_numbers([mrp_company_id_number]).get(mrp_company_id_number)
+        if not mrp_user_id: return None  # ICO does not exist
+        return self.get_user_by_id(mrp_user_id)
+
+    def _get_users_ids_by_company_id_numbers(self, mrp_company_id_numbers):
+        if self._use_ico_index(MRP_TABLE.USER): return {ico: max(ids) for ico, ids in self._get_ico_index_ids(MRP_TABLE.USER, mrp_company_id_numbers).items()}
         query = f'''
             SELECT
+                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', ''),
                 MAX({MRP_TABLE.USER}.{MRP_USER.ID})
             FROM
                 {MRP_TABLE.USER}
             WHERE
-                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '') = '{mrp_company_id_number}'
+                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '') IN ({TO_MRP_PLACEHOLDERS(mrp_company_id_numbers)})
             GROUP BY
                 REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '')
         '''
-        self._execute(query)
-        mrp_user_id = self._fetchone()
-        if not mrp_user_id: return None  # ICO does not exist
-        return self.get_user_by_id(mrp_user_id)
+        self._execute(query, mrp_company_id_numbers)
+        return dict(self._fetchall())  # ICO: mrp_user_id
 
     def get_user_by_id(self, mrp_user_id):
         user = self.get_users_by_ids([mrp_user_id])
         return user[0] if user else None
 
-    def get_users_by_ids(self, mrp_users_ids):
-        users = []
-        mrp_users_ids_chunks = create_chunks(mrp_users_ids, 250)  # firebird limit for IN is 1500
-        for mrp_users_ids_chunk in mrp_users_ids_chunks:
-            query = f'''
-                SELECT
-                    {MRP_TABLE.USER}.{MRP_USER.ID} AS ID,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.NAME}) AS NAME,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.ADDRESS}) AS ADDRESS,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.ZIP}) AS ZIP,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.CITY}) AS CITY,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.COUNTRY}) AS COUNTRY,
-                    COALESCE(TRIM({MRP_TABLE.USER}.{MRP_USER.COUNTRY_CODE}), '') AS COUNTRY_CODE,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.EMAIL}) AS EMAIL,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE}) AS PHONE,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE2}) AS PHONE2,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE3}) AS PHONE3,
-                    CASE WHEN {MRP_TABLE.USER}.{MRP_USER.INDIVIDUAL} = 'F' THEN 1 ELSE 0 END AS IS_COMPANY,
-                    TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_NAME}) AS COMPANY_NAME,
-                    REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '') AS COMPANY_ID_NUMBER,
-                    REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_TAX_ID}), ' ', '') AS COMPANY_TAX_ID,
-                    REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_VAT_ID}), ' ', '') AS COMPANY_VAT_ID,
-                    CAST(COALESCE({MRP_TABLE.USER}.{MRP_USER.DUE_DATE_DAYS}, 14) AS INTEGER) AS DUE_DATE_DAYS,
-                    CAST(COALESCE({MRP_TABLE.USER}.{MRP_USER.PRICE_GROUP}, 1) AS INTEGER) AS PRICE_GROUP,
-                    {MRP_TABLE.USER}.{MRP_USER.ADDED} AS ADDED,
-                    COALESCE(TRIM({MRP_TABLE.USER}.{MRP_USER.NOTE}), '') AS NOTE
-                FROM
-                    {MRP_TABLE.USER}
-                WHERE
-                    {MRP_TABLE.USER}.{MRP_USER.ID} IN ({', '.join(map(str, mrp_users_ids_chunk))})
-                ORDER BY
-                    {MRP_TABLE.USER}.{MRP_USER.ID} ASC
-                    '''
-            self._execute(query)
-            users += self._fetchallmap()
-        return users
+    def get_users_by_ids(self, mrp_users_ids, stream=False):
+        if self.cache:
+            users = self._get_cached('users', mrp_users_ids, lambda mrp_users_ids: list(self._iter_users_by_ids(mrp_users_ids)))
+            users = [users[mrp_user_id] for mrp_user_id in sorted(users)]  # ORDER BY ID
+            return iter(users) if stream else users
+        users = self._iter_users_by_ids(mrp_users_ids)
+        return users if stream else list(users)
+
+    def _iter_users_by_ids(self, mrp_users_ids):
+        yield from self._iter_chunks(mrp_users_ids, MrpService._get_users_chunk)
+
+    def _get_users_chunk(self, mrp_users_ids_chunk, batch):
+        IDS_JOIN, ids_where, params = self._get_ids_filter(f'{MRP_TABLE.USER}.{MRP_USER.ID}', mrp_users_ids_chunk, batch)
+        IDS_WHERE = f'WHERE {ids_where}' if ids_where else ''
+        query = f'''
+            SELECT
+                {MRP_TABLE.USER}.{MRP_USER.ID} AS ID,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.NAME}) AS NAME,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.ADDRESS}) AS ADDRESS,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.ZIP}) AS ZIP,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.CITY}) AS CITY,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.COUNTRY}) AS COUNTRY,
+                COALESCE(TRIM({MRP_TABLE.USER}.{MRP_USER.COUNTRY_CODE}), '') AS COUNTRY_CODE,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.EMAIL}) AS EMAIL,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE}) AS PHONE,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE2}) AS PHONE2,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.PHONE3}) AS PHONE3,
+                CASE WHEN {MRP_TABLE.USER}.{MRP_USER.INDIVIDUAL} = 'F' THEN 1 ELSE 0 END AS IS_COMPANY,
+                TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_NAME}) AS COMPANY_NAME,
+                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_ID_NUMBER}), ' ', '') AS COMPANY_ID_NUMBER,
+                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_TAX_ID}), ' ', '') AS COMPANY_TAX_ID,
+                REPLACE(TRIM({MRP_TABLE.USER}.{MRP_USER.COMPANY_VAT_ID}), ' ', '') AS COMPANY_VAT_ID,
+                CAST(COALESCE({MRP_TABLE.USER}.{MRP_USER.DUE_DATE_DAYS}, 14) AS INTEGER) AS DUE_DATE_DAYS,
+                CAST(COALESCE({MRP_TABLE.USER}.{MRP_USER.PRICE_GROUP}, 1) AS INTEGER) AS PRICE_GROUP,
+                {MRP_TABLE.USER}.{MRP_USER.ADDED} AS ADDED,
+                COALESCE(TRIM({MRP_TABLE.USER}.{MRP_USER.NOTE}), '') AS NOTE
+            FROM
+                {MRP_TABLE.USER}
+                { IDS_JOIN }
+            { IDS_WHERE }
+            ORDER BY
+                {MRP_TABLE.USER}.{MRP_USER.ID} ASC
+                '''
+        self._execute(query, params)
+        return self._fetchallmap()
 
     def get_user_finance_stats(self, mrp_company_id_number):
+        if self._use_ico_index(MRP_TABLE.STOCK_MOVEMENT):  # stock movements by ids of index
+            mrp_company_id_number = TO_MRP_COMPANY_ID_NUMBER(mrp_company_id_number)
+            return self.get_users_finance_stats([mrp_company_id_number]).get(mrp_company_id_number) or self._get_empty_finance_stats()
         query = f'''
             SELECT
                 CAST({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER} AS INTEGER) AS MOVEMENT_NUMBER,
@@ -1109,14 +2674,14 @@ class MrpService:
             FROM
                 {MRP_TABLE.STOCK_MOVEMENT}
             WHERE
-                REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', '') = '{mrp_company_id_number}'
+                REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', '') = ?
                 AND {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER} IN {MRP_STOCK_MOVEMENT_NUMBERS}
             GROUP BY
                 REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', ''),
                 {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER},
                 {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.IS_EXPENSE}
         '''
-        self._execute(query)
+        self._execute(query, (mrp_company_id_number,))
         stock_movements = self._fetchallmap()
         income_stock_movements = [sm for sm in stock_movements if sm['IS_INCOME']]
         income_total_amount = sum([sm['TOTAL'] for sm in income_stock_movements])
@@ -1133,4 +2698,183 @@ class MrpService:
             'INCOME_MISSING_AMOUNT': income_missing_amount,
             'EXPENSE_TOTAL_AMOUNT': expense_total_amount,
             'EXPENSE_MISSING_AMOUNT': expense_missing_amount
-        }
\ No newline at end of file
+        }
+
+    def _get_empty_finance_stats(self):
+        return {
+            'YEAR': self.mrp_year,
+            'INCOME_TOTAL_AMOUNT': 0,
+            'INCOME_MISSING_AMOUNT': 0,
+            'EXPENSE_TOTAL_AMOUNT': 0,
+            'EXPENSE_MISSING_AMOUNT': 0  # TODO?
+        }
+
+    def _iter_users_stock_movements(self, mrp_stock_movements_ids=None):  # grouped by ICO, movement number and direction, per ids chunk
+        batches = self._iter_ids_batches(mrp_stock_movements_ids) if mrp_stock_movements_ids is not None else [(None, None)]
+        for mrp_stock_movements_ids_chunk, batch in batches:
+            IDS_JOIN, ids_where, params = '', '', None
+            if mrp_stock_movements_ids_chunk: IDS_JOIN, ids_where, params = self._get_ids_filter(f'{MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.ID}', mrp_stock_movements_ids_chunk, batch)
+            IDS_WHERE = f'AND {ids_where}' if ids_where else ''
+            query = f'''
+                SELECT
+                    REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', '') AS COMPANY_ID_NUMBER,
+                    CAST({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER} AS INTEGER) AS MOVEMENT_NUMBER,
+                    TRIM(',' FROM REPLACE(LIST(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.VARIABLE_SYMBOL})), ',,', ',')) AS VARIABLE_SYMBOLS,
+                    COALESCE(SUM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.TOTAL}), 0) AS TOTAL,
+                    CASE WHEN {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.IS_EXPENSE} = 'T' THEN 1 ELSE 0 END AS IS_EXPENSE,
+                    CASE WHEN {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.IS_EXPENSE} = 'F' THEN 1 ELSE 0 END AS IS_INCOME
+                FROM
+                    {MRP_TABLE.STOCK_MOVEMENT}
+                    { IDS_JOIN }
+                WHERE
+                    {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER} IN {MRP_STOCK_MOVEMENT_NUMBERS}
+                    { IDS_WHERE }
+                GROUP BY
+                    REPLACE(TRIM({MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.COMPANY_ID_NUMBER}), ' ', ''),
+                    {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.MOVEMENT_NUMBER},
+                    {MRP_TABLE.STOCK_MOVEMENT}.{MRP_STOCK_MOVEMENT.IS_EXPENSE}
+            '''  # one scan for all customers (normalized ICO cannot use index), primary key lookups for ids of ICO index
+            yield from self._iterquery(query, params, mapped=True)
+
+    def get_users_finance_stats(self, mrp_company_id_numbers=None):  # {ICO: get_user_finance_stats}, all customers by default
+        if mrp_company_id_numbers is not None: mrp_company_id_numbers = {TO_MRP_COMPANY_ID_NUMBER(c) for c in mrp_company_id_numbers}
+        if mrp_company_id_numbers is not None and self._use_ico_index(MRP_TABLE.STOCK_MOVEMENT):
+            ids = self._get_ico_index_ids(MRP_TABLE.STOCK_MOVEMENT, mrp_company_id_numbers)
+            stock_movements = self._iter_users_stock_movements(sorted({mrp_id for ico_ids in ids.values() for mrp_id in ico_ids}))
+        else:
+            stock_movements = self._iter_users_stock_movements()
+        stats = {}
+        invoices_company_id_numbers = {}  # variable symbol: ICOs of income stock movements (invoices)
+        for stock_movement in stock_movements:
+            mrp_company_id_number = stock_movement['COMPANY_ID_NUMBER']
+            if not mrp_company_id_number or (mrp_company_id_numbers is not None and mrp_company_id_number not in mrp_company_id_numbers): continue
+            if mrp_company_id_number not in stats: stats[mrp_company_id_number] = self._get_empty_finance_stats()
+            user_stats = stats[mrp_company_id_number]
+            if stock_movement['IS_INCOME']:
+                user_stats['INCOME_TOTAL_AMOUNT'] += stock_movement['TOTAL']
+                if stock_movement['MOVEMENT_NUMBER'] == 2 and stock_movement['VARIABLE_SYMBOLS']:  # invoices
+                    for mrp_variable_symbol in stock_movement['VARIABLE_SYMBOLS'].split(','):
+                        invoices_company_id_numbers.setdefault(mrp_variable_symbol, set()).add(mrp_company_id_number)
+            if stock_movement['IS_EXPENSE']: user_stats['EXPENSE_TOTAL_AMOUNT'] += stock_movement['TOTAL']
+        for invoice in self._iter_invoices_by_variable_symbols(list(invoices_company_id_numbers), stream=True):  # joined through MRP_TABLE.IDS when many
+            for mrp_company_id_number in invoices_company_id_numbers[invoice['VARIABLE_SYMBOL']]: stats[mrp_company_id_number]['INCOME_MISSING_AMOUNT'] += invoice['MISSING']
+        return stats
+
+    #
+    # EXPORT
+    #
+    def export_products(self, path, mrp_products_ids=None, **kwargs):  # all products by default, kwargs of MrpExport
+        if mrp_products_ids is None:
+            self._execute(f'SELECT {MRP_TABLE.PRODUCT}.{MRP_PRODUCT.ID} FROM {MRP_TABLE.PRODUCT}')  # ids only, no states joins and hashing
+            mrp_products_ids = self._fetchall()
+        mrp_products_ids_chunks = create_chunks(sorted(set(mrp_products_ids)), MRP_EXPORT_CHUNK_SIZE)
+        products = (product for mrp_products_ids_chunk in mrp_products_ids_chunks for product in self._iter_products_by_ids(mrp_products_ids_chunk))
+        return MrpExport(path, **kwargs).write(products)
+
+    def export_invoices(self, path, mpr_date_from, mrp_date_to, **kwargs):
+        return MrpExport(path, **kwargs).write(self.get_invoices_by_date_range(mpr_date_from, mrp_date_to, stream=True))
+
+
+for name, method in list(vars(MrpService).items()):
+    if not name.startswith('_') and isinstance(method, FunctionType): setattr(MrpService, name, _track_caller(method))
+
+
+MRP_MULTI_YEAR_METHODS = (  # reads by business keys (dates, ICO, variable symbols), ids of different years are unrelated
+    'get_cash_register_records_by_date', 'get_cash_register_report', 'get_company_id_numbers_by_stock_movements_date',
+    'get_exposure_by_date', 'get_exposure_series',
+    'get_invoices_by_company_id_number', 'get_invoices_by_date', 'get_invoices_by_date_range', 'get_invoices_by_due_date', 'get_invoices_by_price',
+    'get_invoice_by_variable_symbol', 'get_invoices_by_variable_symbols', 'get_paid_invoices_by_date', 'get_paid_invoices_by_date_range',
+    'get_unpaid_invoices', 'get_overpaid_invoices',
+    'get_product_by_number', 'get_user_by_company_id_number', 'get_user_finance_stats', 'get_users_finance_stats',
+    'get_categories_states', 'get_invoices_states', 'get_products_states', 'get_users_states',
+)
+
+
+class MrpMultiYearService:
+
+    def __init__(self, mrp_years=None, max_workers=None, **kwargs):
+        self.mrp_years = sorted(mrp_years or settings.MRP_DATA_FILES.keys())
+        self.max_workers = max_workers or len(self.mrp_years)  # one connection per year
+        self.kwargs = kwargs  # MrpService arguments
+
+    def __getattr__(self, name):
+        if name not in MRP_MULTI_YEAR_METHODS: raise AttributeError(name)  # writers and lookups by ids are year specific
+        return lambda *args, **kwargs: self.merge(name, *args, **kwargs)
+
+    def _run_year(self, mrp_year, method, args, kwargs):
+        with MrpService(mrp_year, **self.kwargs) as mrp_service:
+            return getattr(mrp_service, method)(*args, **kwargs)
+
+    def run(self, method, *args, **kwargs):
+        if method not in MRP_MULTI_YEAR_METHODS: raise ValueError(f'{method} is not supported across years, use MrpService of the year')
+        if kwargs.get('stream'): raise ValueError('Streaming is not supported across years, connections are closed when method returns')
+        logger.debug('Running %s in MRP years %s', method, self.mrp_years)
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(self.mrp_years)) or 1, thread_name_prefix='mrp') as executor:
+            futures = {mrp_year: executor.submit(self._run_year, mrp_year, method, args, kwargs) for mrp_year in self.mrp_years}
+            wait(futures.values())
+        logger.debug('Ran in %fs', (perf_counter() - started))
+        return {mrp_year: future.result() for mrp_year, future in futures.items()}  # first failed year raises
+
+    def merge(self, method, *args, **kwargs):  # lists concatenated in year order (items get YEAR, states (id, hash) get ((year, id), hash)), anything else by year
+        results = self.run(method, *args, **kwargs)
+        if not all(isinstance(result, list) for result in results.values()): return results
+        merged = []
+        for mrp_year, result in results.items():
+            for item in result:
+                if isinstance(item, dict): item.setdefault('YEAR', mrp_year)
+                if isinstance(item, tuple): item = ((mrp_year, item[0]), *item[1:])  # same ids in other years are other rows
+                merged.append(item)
+        return merged
+
+    def get_user_finance_stats(self, mrp_company_id_number):
+        years = self.run('get_user_finance_stats', mrp_company_id_number)
+        return {
+            'YEARS': years,  # year: stats
+            'INCOME_TOTAL_AMOUNT': sum(year['INCOME_TOTAL_AMOUNT'] for year in years.values()),
+            'INCOME_MISSING_AMOUNT': sum(year['INCOME_MISSING_AMOUNT'] for year in years.values()),
+            'EXPENSE_TOTAL_AMOUNT': sum(year['EXPENSE_TOTAL_AMOUNT'] for year in years.values()),
+            'EXPENSE_MISSING_AMOUNT': sum(year['EXPENSE_MISSING_AMOUNT'] for year in years.values()),
+        }
+
+    def get_users_finance_stats(self, mrp_company_id_numbers=None):
+        users_stats = {}
+        for mrp_year, years_stats in self.run('get_users_finance_stats', mrp_company_id_numbers).items():
+            for mrp_company_id_number, year_stats in years_stats.items():
+                users_stats.setdefault(mrp_company_id_number, {'YEARS': {}})['YEARS'][mrp_year] = year_stats  # year: stats
+        for user_stats in users_stats.values():
+            for field in ('INCOME_TOTAL_AMOUNT', 'INCOME_MISSING_AMOUNT', 'EXPENSE_TOTAL_AMOUNT', 'EXPENSE_MISSING_AMOUNT'):
+                user_stats[field] = sum(year[field] for year in user_stats['YEARS'].values())
+        return users_stats
+
+
+class AsyncMrpService:
+
+    def __init__(self, mrp_year=None, max_workers=None, **kwargs):
+        self.mrp_year = mrp_year or timezone.now().year
+        self.max_workers = max_workers or getattr(settings, 'MRP_CONNECTION_POOL_SIZE', MRP_CONNECTION_POOL_SIZE)  # more would wait for pool
+        self.kwargs = kwargs  # MrpService arguments
+        self.executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(MrpService, name, None)): raise AttributeError(name)
+        return partial(self.run, name)
+
+    def _run(self, method, args, kwargs):
+        with MrpService(self.mrp_year, **self.kwargs) as mrp_service:
+            return getattr(mrp_service, method)(*args, **kwargs)
+
+    async def run(self, method, *args, **kwargs):  # own pooled connection and transaction per call, asyncio.gather runs calls concurrently
+        if kwargs.get('stream'): raise ValueError('Streaming is not supported, connection is released when method returns')
+        if not self.executor: self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='mrp')
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(self._run, method, args, kwargs))
+
+    async def close(self):
+        executor, self.executor = self.executor, None
+        if executor: await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
\ No newline at end of file
@@ -0,0 +1,194 @@
+#
+# Benchmarks of MrpService lookups against a real MRP database, numbers depend on database and network so run it on yours.
+# Round trips are counted by MrpService.queries_count, times are best of --repeat runs.
+#
+# DJANGO_SETTINGS_MODULE=... python scripts/benchmark_mrp.py products [--year MRP year] [--count N] [--repeat R]
+#   get_products_by_ids on first N products, old per-product extras cost 1 + 3 * n queries per chunk of MRP_IN_CHUNK_SIZE
+# DJANGO_SETTINGS_MODULE=... python scripts/benchmark_mrp.py cash-register [--count N] [--repeat R] [--date YYYY-MM-DD]
+#   ZPRAVA decoding and get_cash_register_records_by_date on synthetic day of N receipts (seeded, 20% discount receipts), and on --date from database
+# DJANGO_SETTINGS_MODULE=... python scripts/benchmark_mrp.py ids [--lookup products|invoices|users] [--sizes 250,500,...] [--repeat R]
+#   *_by_ids with IN lists and with MRP_TABLE.IDS for each size, justifies MRP_IDS_TABLE_THRESHOLD, needs create_ids_table
+# DJANGO_SETTINGS_MODULE=... python scripts/benchmark_mrp.py states [--lookup products|invoices|users] [--count N] [--repeat R]
+#   client hashing of N synthetic product states (get_hash per row vs BATCH), then get_*_states in each MRP_STATES_HASHES mode
+#
+import argparse
+import json
+import os
+import random
+import sys
+
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+import fdb  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from mrp import MrpService, MRP_TABLE, MRP_INVOICE, MRP_PRODUCT, MRP_USER, MRP_IN_CHUNK_SIZE, MRP_STATES_HASHES, TO_MRP_RECEIPT_DATA, TO_MRP_STATES_HASHES  # noqa: E402
+from base.utils import create_chunks, json_loads  # noqa: E402
+
+
+def measure(mrp_service, function, repeat):  # (best seconds, queries of one run, result of last run)
+    best, queries_count, result = None, 0, None
+    for _ in range(repeat):
+        mrp_service.queries_count = 0
+        started = perf_counter()
+        result = function()
+        elapsed = perf_counter() - started
+        queries_count = mrp_service.queries_count
+        if best is None or elapsed < best: best = elapsed
+    return best, queries_count, result
+
+
+def get_first_ids(mrp_service, table, column, count):
+    mrp_service._execute(f'SELECT FIRST {int(count)} {column} FROM {table} ORDER BY {column}')
+    return mrp_service._fetchall()
+
+
+def benchmark_products(mrp_service, args):
+    ids = get_first_ids(mrp_service, MRP_TABLE.PRODUCT, MRP_PRODUCT.ID, args.count)
+    seconds, queries_count, products = measure(mrp_service, lambda: mrp_service.get_products_by_ids(ids), args.repeat)
+    old_queries_count = sum(1 + 3 * len(ids_chunk) for ids_chunk in create_chunks(ids, MRP_IN_CHUNK_SIZE))  # upper bound, extras per product
+    print(f'get_products_by_ids: {len(ids)} ids, {len(products)} products, {queries_count} queries (per-product extras: up to {old_queries_count}), {seconds * 1000:.1f} ms')
+
+
+def get_synthetic_receipts(count):  # EKASA_LOG rows as selected by _iter_cash_register_records
+    rng = random.Random(1)
+    mrp_date, started = date(2024, 1, 1), datetime(2024, 1, 1, 8)
+    rows = []
+    for mrp_id in range(1, count + 1):
+        discount = rng.random() < 0.2
+        items = [
+            {'ItemType': 'Z' if discount and index == 0 else 'K', 'Name': 'x' * 40, 'Price': round(rng.uniform(-5, 50), 2), 'Quantity': 1, 'VatRate': 20}
+            for index in range(rng.randint(1, 8))
+        ]
+        raw_data = {'ReceiptData': {
+            'ReceiptType': 'PD' if discount else 'PK',
+            'InvoiceNumber': str(mrp_id),
+            'Items': items,
+            'Custom': {'Cashier': f'C{mrp_id % 5}', 'PaymentCard': 10, 'PaymentCash': 5.5},
+            'Dic': '1234567890',
+            'Amount': 15.5,
+        }}
+        rows.append((mrp_id, Decimal('15.50'), started + timedelta(seconds=mrp_id), json.dumps(raw_data), 'X' if mrp_id % 50 == 0 else '', mrp_date))
+    return mrp_date, rows
+
+
+def decode_receipts(rows, decode):
+    for row in rows: decode(row[3])
+
+
+def benchmark_cash_register(mrp_service, args):
+    mrp_date, rows = get_synthetic_receipts(args.count)
+    for name, decode in (('full decode', json_loads), ('keys only', TO_MRP_RECEIPT_DATA)):  # keys only decodes PD receipts fully (Items)
+        seconds, _, _ = measure(mrp_service, lambda: decode_receipts(rows, decode), args.repeat)
+        print(f'synthetic day, {len(rows)} receipts: {name} {seconds * 1000:.1f} ms')
+    iterquery = mrp_service._iterquery
+    mrp_service._iterquery = lambda query, params=None, mapped=False: iter(rows)  # instance attribute, database is not queried
+    try:
+        for records in (True, False):
+            seconds, _, _ = measure(mrp_service, lambda: mrp_service.get_cash_register_records_by_date(mrp_date, records=records), args.repeat)
+            print(f'synthetic day, {len(rows)} receipts: records={records} {seconds * 1000:.1f} ms')
+    finally:
+        mrp_service._iterquery = iterquery
+    if not args.date: return
+    for records in (True, False):
+        seconds, queries_count, summary = measure(mrp_service, lambda: mrp_service.get_cash_register_records_by_date(args.date, records=records), args.repeat)
+        print(f'{args.date}, {summary["CUSTOMERS"]} customers: records={records} {queries_count} queries, {seconds * 1000:.1f} ms')
+
+
+IDS_LOOKUPS = {  # lookup: (table, id column, MrpService method)
+    'products': (MRP_TABLE.PRODUCT, MRP_PRODUCT.ID, MrpService.get_products_by_ids),
+    'invoices': (MRP_TABLE.INVOICE, MRP_INVOICE.ID, MrpService.get_invoices_by_ids),
+    'users': (MRP_TABLE.USER, MRP_USER.ID, MrpService.get_users_by_ids),
+}
+
+
+def benchmark_ids(mrp_service, args):
+    if not mrp_service._has_ids_table(): sys.exit(f'{MRP_TABLE.IDS} does not exist, run MrpService().create_ids_table() first')
+    table, column, get_by_ids = IDS_LOOKUPS[args.lookup]
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    all_ids = get_first_ids(mrp_service, table, column, sizes[-1])
+    threshold = getattr(settings, 'MRP_IDS_TABLE_THRESHOLD', None)
+    try:
+        for size in sizes:
+            ids = all_ids[:size]
+            results = []
+            for name, size_threshold in (('IN lists', len(ids)), (MRP_TABLE.IDS, 0)):  # threshold is exclusive
+                settings.MRP_IDS_TABLE_THRESHOLD = size_threshold
+                seconds, queries_count, _ = measure(mrp_service, lambda: get_by_ids(mrp_service, ids), args.repeat)
+                results.append(f'{name} {queries_count} queries {seconds * 1000:.1f} ms')
+            print(f'{args.lookup}, {len(ids)} ids: {", ".join(results)}')
+    finally:
+        if threshold is None: del settings.MRP_IDS_TABLE_THRESHOLD
+        else: settings.MRP_IDS_TABLE_THRESHOLD = threshold
+
+
+STATES_LOOKUPS = {
+    'products': MrpService.get_products_states,
+    'invoices': MrpService.get_invoices_states,
+    'users': MrpService.get_users_states,
+}
+
+
+def get_synthetic_states(count):  # rows of products states query (id, name, category, metatags, EAN, SKU, flag, warranty, minimum, attributes hash, UPDCNT sums, categories)
+    rng = random.Random(1)
+    return [
+        (mrp_id, f'Product {mrp_id} ' + 'x' * rng.randint(10, 60), rng.randint(1, 500), 'tag1,tag2', f'858{mrp_id:010d}', f'SKU-{mrp_id}', 'T', '24', Decimal('1.000'),
+         rng.getrandbits(63), rng.randint(1, 50), rng.randint(1, 500), None if rng.random() < 0.7 else '12,34')
+        for mrp_id in range(1, count + 1)
+    ]
+
+
+def benchmark_states(mrp_service, args):
+    rows = get_synthetic_states(args.count)
+    concatenated = [(row[0], ''.join('~' if value is None else f'|{value}' for value in row[1:])) for row in rows]  # as concatenated by firebird for BATCH
+    seconds, _, _ = measure(mrp_service, lambda: mrp_service._hash_states(rows), args.repeat)
+    print(f'synthetic states, {len(rows)} rows: get_hash per row {seconds * 1000:.1f} ms')
+    seconds, _, _ = measure(mrp_service, lambda: TO_MRP_STATES_HASHES(concatenated), args.repeat)
+    print(f'synthetic states, {len(rows)} rows: BATCH {seconds * 1000:.1f} ms')
+    get_states = STATES_LOOKUPS[args.lookup]
+    states_hash = mrp_service.states_hash
+    try:
+        for mode in MRP_STATES_HASHES:
+            mrp_service.states_hash = mode
+            try:
+                seconds, queries_count, states = measure(mrp_service, lambda: get_states(mrp_service), args.repeat)
+            except fdb.DatabaseError as e:  # CRYPT_HASH needs firebird 4
+                print(f'{args.lookup} states, {mode}: failed ({e.args[0] if e.args else e})')
+                continue
+            print(f'{args.lookup} states, {mode}: {len(states)} rows, {queries_count} queries, {seconds * 1000:.1f} ms')
+    finally:
+        mrp_service.states_hash = states_hash
+
+
+BENCHMARKS = {
+    'products': benchmark_products,
+    'cash-register': benchmark_cash_register,
+    'ids': benchmark_ids,
+    'states': benchmark_states,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    parser.add_argument('--year', type=int, default=None)
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--date', type=date.fromisoformat, default=None)
+    parser.add_argument('--lookup', choices=IDS_LOOKUPS, default='products')  # same keys in STATES_LOOKUPS
+    parser.add_argument('--sizes', default='250,500,1000,2000,5000,10000')
+    args = parser.parse_args()
+    with MrpService(args.year, read_only=True, snapshot=True) as mrp_service:  # runs see same data
+        BENCHMARKS[args.benchmark](mrp_service, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#
+# Compares get_exposure_series with get_exposure_by_date on a day without later payments (last payment date by default).
+# Series takes payments up to each day, get_exposure_by_date all current payments, so only such days are comparable.
+#
+# DJANGO_SETTINGS_MODULE=... python scripts/check_exposure_series.py [MRP year] [YYYY-MM-DD]
+#
+import os
+import sys
+
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+
+django.setup()
+
+from mrp import MrpService, MRP_TABLE, MRP_INVOICE_PAYMENT  # noqa: E402
+
+CHECK_FIELDS = ('INVOICES', 'EXPOSURE', 'OVERDUE_INVOICES', 'OVERDUE_EXPOSURE')
+
+
+def main():
+    mrp_year = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    with MrpService(mrp_year, read_only=True, snapshot=True) as mrp_service:  # both queries see same payments
+        mrp_service._execute(f'SELECT MAX({MRP_INVOICE_PAYMENT.DATE}) FROM {MRP_TABLE.INVOICE_PAYMENT}')
+        last_payment_date = mrp_service._fetchone()
+        mrp_date = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else last_payment_date or date.today()
+        if last_payment_date and mrp_date < last_payment_date: print(f'Payments after {mrp_date} (last {last_payment_date}), results may differ')
+        series = mrp_service.get_exposure_series(mrp_date, mrp_date)[0]
+        exposure = mrp_service.get_exposure_by_date(mrp_date) or {}
+    failed = False
+    for field in CHECK_FIELDS:
+        series_value, exposure_value = series[field], exposure.get(field) or 0
+        if series_value != exposure_value: failed = True
+        print(f'{field}: {series_value} {"==" if series_value == exposure_value else "!="} {exposure_value}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()